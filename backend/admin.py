@@ -0,0 +1,67 @@
+from functools import wraps
+import hmac
+
+from flask import Blueprint, Response, abort, current_app, jsonify, request, stream_with_context
+from flask_login import current_user, login_required
+
+from backend import export, metrics, summary
+
+admin = Blueprint('admin', __name__)
+
+
+def is_admin():
+    return current_user.is_authenticated and current_user.username in current_app.config['ADMIN_USERS']
+
+
+def admin_required(f):
+    @wraps(f)
+    @login_required
+    def decorated(*args, **kwargs):
+        if not is_admin():
+            abort(403)
+        return f(*args, **kwargs)
+    return decorated
+
+
+@admin.route('/stats', methods=['GET'])
+@admin_required
+def get_stats():
+    versions = summary.version_summary(exclude_users=current_app.config['TEST_USERS'])
+    return jsonify(
+        versions={str(version): stats for version, stats in versions.items()},
+        experiments={str(version): weight for version, weight in current_app.config['EXPERIMENT_VERSIONS'].items()},
+    )
+
+
+@admin.route('/export', methods=['GET'])
+@admin_required
+def export_classifications():
+    """Stream every classification, or just one user's, as CSV or Parquet.
+
+    Takes ``format`` ('csv' by default, or 'parquet') and optionally
+    ``username`` as query arguments.
+    """
+    fmt = request.args.get('format', 'csv')
+    try:
+        chunks = export.export_chunks(fmt, export.classification_rows(request.args.get('username')))
+    except ValueError as e:
+        return jsonify(
+            success=False,
+            message=str(e),
+        )
+
+    response = Response(stream_with_context(chunks), mimetype=export.FORMATS[fmt])
+    response.headers['Content-Disposition'] = f'attachment; filename=classifications.{fmt}'
+    return response
+
+
+@admin.route('/metrics', methods=['GET'])
+def get_metrics():
+    # scrapers can't log in, so also accept the METRICS_TOKEN as a bearer token
+    token = current_app.config.get('METRICS_TOKEN')
+    authorization = request.headers.get('Authorization', '')
+    has_token = bool(token) and hmac.compare_digest(authorization, f'Bearer {token}')
+    if not has_token and not is_admin():
+        abort(403)
+
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
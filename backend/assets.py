@@ -0,0 +1,383 @@
+import base64
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import posixpath
+import re
+import threading
+import urllib.parse
+import urllib.request
+
+from flask import abort, request, send_from_directory, url_for as flask_url_for
+from flask.sessions import SecureCookieSessionInterface
+
+try:
+    import brotli
+except ImportError:
+    # only needed for the .br variants, browsers fall back to gzip without
+    brotli = None
+
+# Static files are built into fingerprinted copies, named after a hash of
+# their contents, so browsers can cache them for good and never revalidate
+# them on a reload. The stylesheets every page needs are bundled into one
+# file, with Bootstrap and the fonts vendored rather than fetched from
+# their CDNs, so first paint only waits on the app's own server. Text files
+# are precompressed too:
+#
+#     python -c 'from backend.manage_database import *; build_assets()'
+#
+# Templates link to the build through url_for('static', ...), and pages fall
+# back to the plain static files until the assets are built. The app serves
+# /assets/ itself, but a web server in front of it can do it instead, e.g.
+# with nginx:
+#
+#     location /assets/ {
+#         alias /path/to/static/dist/;
+#         gzip_static on;
+#         brotli_static on;
+#         add_header Cache-Control "public, max-age=31536000, immutable";
+#     }
+STATIC_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, 'static')
+VENDOR_DIR = os.path.join(STATIC_DIR, 'vendor')
+DIST_DIR = os.path.join(STATIC_DIR, 'dist')
+MANIFEST_PATH = os.path.join(DIST_DIR, 'manifest.json')
+
+# third party files the pages use, downloaded into VENDOR_DIR and checked
+# against their subresource integrity hash
+VENDOR = {
+    'bootstrap.min.css': (
+        'https://maxcdn.bootstrapcdn.com/bootstrap/4.0.0/css/bootstrap.min.css',
+        'sha384-Gn5384xqQ1aoWXA+058RXPxPg6fy4IWvTNh0E263XmFcJlSAwiGgFAW/dAiS6JXm',
+    ),
+}
+
+# Google Fonts stylesheets, combined into one file in VENDOR_DIR, with the
+# fonts they use downloaded alongside
+FONTS = {
+    'fonts.css': (
+        'https://fonts.googleapis.com/css2?family=Roboto:wght@500&display=swap',
+        'https://fonts.googleapis.com/css2?family=Fira+Code:wght@500&display=swap',
+        'https://fonts.googleapis.com/icon?family=Material+Icons',
+    ),
+}
+FONT_DIR = 'fonts'
+
+# Google Fonts picks the font format from the user agent, so ask as a
+# browser that takes woff2
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36'
+
+# files built from several others, by their path under STATIC_DIR
+BUNDLES = {
+    # the render blocking styles, in one request
+    'app.css': ('vendor/bootstrap.min.css', 'vendor/fonts.css', 'main.css'),
+}
+
+# directories under STATIC_DIR that aren't built
+EXCLUDE = ('dist', 'patches')
+
+# extensions worth compressing. Images and fonts are compressed already.
+COMPRESSIBLE = {'.css', '.js', '.json', '.svg', '.txt', '.webmanifest', '.xml', '.ico'}
+
+# the suffix of each precompressed variant, in order of preference
+ENCODINGS = {
+    'br': '.br',
+    'gzip': '.gz',
+}
+
+HASH_LENGTH = 12
+
+mimetypes.add_type('application/manifest+json', '.webmanifest')
+mimetypes.add_type('font/woff2', '.woff2')
+
+CSS_URL = re.compile(r'''url\(\s*(?:"([^"]*)"|'([^']*)'|([^"')\s]*))\s*\)''')
+
+
+def _download(url):
+    with urllib.request.urlopen(urllib.request.Request(url, headers={'User-Agent': USER_AGENT}), timeout=30) as response:
+        return response.read()
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def vendor(force=False):
+    """Download the third party files into ``VENDOR_DIR``, skipping ones already there.
+
+    Returns the names of the files downloaded.
+    """
+    downloaded = []
+    for name, (url, integrity) in VENDOR.items():
+        path = os.path.join(VENDOR_DIR, name)
+        if os.path.exists(path) and not force:
+            continue
+        data = _download(url)
+        algorithm, _, expected = integrity.partition('-')
+        if base64.b64encode(hashlib.new(algorithm, data).digest()).decode() != expected:
+            raise ValueError(f"{url} doesn't match its integrity hash")
+        _write(path, data)
+        downloaded.append(name)
+
+    for name, urls in FONTS.items():
+        path = os.path.join(VENDOR_DIR, name)
+        if os.path.exists(path) and not force:
+            continue
+
+        stylesheets = []
+        for url in urls:
+            css = _download(url).decode()
+
+            def localise(match):
+                font_url = next(group for group in match.groups() if group is not None)
+                font_name = posixpath.basename(urllib.parse.urlsplit(font_url).path)
+                font_path = os.path.join(VENDOR_DIR, FONT_DIR, font_name)
+                if force or not os.path.exists(font_path):
+                    _write(font_path, _download(font_url))
+                    downloaded.append(posixpath.join(FONT_DIR, font_name))
+                return f'url({FONT_DIR}/{font_name})'
+
+            stylesheets.append(f'/* {url} */\n' + CSS_URL.sub(localise, css))
+        _write(path, '\n'.join(stylesheets).encode())
+        downloaded.append(name)
+    return downloaded
+
+
+def _sources():
+    """Every file to build, as paths relative to ``STATIC_DIR`` with / separators."""
+    sources = []
+    for root, dirs, files in os.walk(STATIC_DIR):
+        relroot = os.path.relpath(root, STATIC_DIR)
+        if relroot == os.curdir:
+            dirs[:] = [d for d in dirs if d not in EXCLUDE]
+            relroot = ''
+        for filename in files:
+            if not filename.endswith('.tmp'):
+                sources.append(posixpath.join(relroot.replace(os.sep, '/'), filename))
+    return sorted(sources)
+
+
+def _fingerprinted(name, data):
+    stem, ext = posixpath.splitext(name)
+    return f'{stem}.{hashlib.sha256(data).hexdigest()[:HASH_LENGTH]}{ext}'
+
+
+def _rewrite_css(css, source, target, files):
+    """Point the relative url()s in ``source``'s css at the built files, relative to ``target``."""
+    def rewrite(match):
+        url = next(group for group in match.groups() if group is not None)
+        if not url or url.startswith(('data:', '#', '/')) or '//' in url:
+            return match.group(0)
+        path, _, fragment = url.partition('#')
+        path = path.split('?')[0]
+        name = posixpath.normpath(posixpath.join(posixpath.dirname(source), path))
+        if name not in files:
+            return match.group(0)
+        built = posixpath.relpath(files[name], posixpath.dirname(target) or '.')
+        return f'url({built}{"#" + fragment if fragment else ""})'
+
+    return CSS_URL.sub(rewrite, css)
+
+
+def _compress(data):
+    """The precompressed variants worth keeping, keyed by encoding."""
+    variants = {'gzip': gzip.compress(data, 9, mtime=0)}
+    if brotli is not None:
+        variants['br'] = brotli.compress(data, quality=11)
+    return {encoding: variant for encoding, variant in variants.items() if len(variant) < len(data)}
+
+
+def build():
+    """Build the fingerprinted and precompressed copies of the static files into ``DIST_DIR``.
+
+    Stylesheets are built last, so their url()s can be pointed at the
+    fingerprinted files. Files left from the build before this one are
+    kept, for pages loaded before the new build, and older ones are
+    deleted. Returns the new manifest.
+    """
+    for bundle, parts in BUNDLES.items():
+        missing = [part for part in parts if not os.path.exists(os.path.join(STATIC_DIR, part))]
+        if missing:
+            raise FileNotFoundError(f"{bundle} is missing {', '.join(missing)}, run vendor() first")
+
+    try:
+        with open(MANIFEST_PATH) as f:
+            previous = json.load(f)
+    except FileNotFoundError:
+        previous = {'files': {}, 'encodings': {}}
+
+    sources = _sources()
+    files = {}
+    encodings = {}
+
+    def emit(name, data):
+        built = _fingerprinted(name, data)
+        path = os.path.join(DIST_DIR, built)
+        if not os.path.exists(path):
+            _write(path, data)
+        files[name] = built
+        encodings[built] = []
+        if posixpath.splitext(name)[1] in COMPRESSIBLE:
+            variants = _compress(data)
+            for encoding, suffix in ENCODINGS.items():
+                if encoding in variants:
+                    if not os.path.exists(path + suffix):
+                        _write(path + suffix, variants[encoding])
+                    encodings[built].append(encoding)
+
+    def read(name):
+        with open(os.path.join(STATIC_DIR, name), 'rb') as f:
+            return f.read()
+
+    stylesheets = [name for name in sources if name.endswith('.css')]
+    for name in sources:
+        if not name.endswith('.css'):
+            emit(name, read(name))
+    for name in stylesheets:
+        emit(name, _rewrite_css(read(name).decode(), name, name, files).encode())
+    for bundle, parts in BUNDLES.items():
+        emit(bundle, '\n'.join(_rewrite_css(read(part).decode(), part, bundle, files) for part in parts).encode())
+
+    keep = {MANIFEST_PATH}
+    for built, built_encodings in list(encodings.items()) + list(previous['encodings'].items()):
+        path = os.path.join(DIST_DIR, built)
+        keep.add(path)
+        keep.update(path + ENCODINGS[encoding] for encoding in built_encodings)
+    for root, _, filenames in os.walk(DIST_DIR):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            if path not in keep:
+                os.remove(path)
+
+    new_manifest = {'files': files, 'encodings': encodings}
+    _write(MANIFEST_PATH, json.dumps(new_manifest, indent=1, sort_keys=True).encode())
+    assets.reset()
+    return new_manifest
+
+
+class Assets:
+    """The manifest of the last build, loaded on first use.
+
+    It's loaded again whenever the manifest file changes, so workers pick up
+    a build made by another process without restarting.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._manifest = None
+        self._mtime = None
+
+    def _mtime_now(self):
+        try:
+            return os.stat(MANIFEST_PATH).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _load(self):
+        try:
+            with open(MANIFEST_PATH) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'files': {}, 'encodings': {}}
+
+    def manifest(self):
+        mtime = self._mtime_now()
+        if self._manifest is None or mtime != self._mtime:
+            with self._lock:
+                if self._manifest is None or mtime != self._mtime:
+                    self._manifest = self._load()
+                    self._mtime = mtime
+        return self._manifest
+
+    def built(self, name):
+        """The path under ``DIST_DIR`` of a static file's build, or None if it hasn't been built."""
+        return self.manifest()['files'].get(name)
+
+    def encodings(self, built):
+        """The encodings a built file is precompressed in, or None if it isn't a built file."""
+        return self.manifest()['encodings'].get(built)
+
+    def reset(self):
+        with self._lock:
+            self._manifest = None
+            self._mtime = None
+
+
+assets = Assets()
+
+
+def url_for(endpoint, **values):
+    """Flask's url_for, except static files link to their build where there is one."""
+    if endpoint == 'static':
+        built = assets.built(values.get('filename'))
+        if built is not None:
+            return flask_url_for('asset', **dict(values, filename=built))
+    return flask_url_for(endpoint, **values)
+
+
+def bundle_urls(bundle):
+    """(URL, integrity) of a bundle, or of each of its parts until the assets are built.
+
+    Parts that haven't been vendored yet are linked from where they'd be
+    downloaded from, with their subresource integrity hash where there is
+    one. The integrity is None for everything else.
+    """
+    if assets.built(bundle) is not None:
+        return [(url_for('static', filename=bundle), None)]
+
+    urls = []
+    for part in BUNDLES[bundle]:
+        name = posixpath.relpath(part, 'vendor')
+        if os.path.exists(os.path.join(STATIC_DIR, part)):
+            urls.append((flask_url_for('static', filename=part), None))
+        elif name in VENDOR:
+            urls.append(VENDOR[name])
+        else:
+            urls.extend((url, None) for url in FONTS.get(name, ()))
+    return urls
+
+
+def send_asset(filename):
+    built_encodings = assets.encodings(filename)
+    if built_encodings is None:
+        abort(404)
+
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    encoding = next((e for e in ENCODINGS if e in built_encodings and request.accept_encodings[e]), None)
+    path = filename + ENCODINGS[encoding] if encoding else filename
+
+    # a built file's name changes with its contents, so it never needs
+    # checking again
+    response = send_from_directory(DIST_DIR, path, mimetype=mimetype, max_age=365 * 24 * 60 * 60)
+    response.cache_control.immutable = True
+    if encoding:
+        response.content_encoding = encoding
+    if built_encodings:
+        response.vary.add('Accept-Encoding')
+    return response
+
+
+class AssetSessionInterface(SecureCookieSessionInterface):
+    """The default cookie session, except it isn't saved for built files.
+
+    Flask-Login touches the session on every request, which re-signs the
+    cookie and adds ``Vary: Cookie``, so a cached file would be missed as
+    soon as the cookie changed.
+    """
+
+    def save_session(self, app, session, response):
+        if request.endpoint == 'asset':
+            return
+        super().save_session(app, session, response)
+
+
+def init_app(app):
+    """Serve the built files under /assets/ and have templates link to them."""
+    app.add_url_rule('/assets/<path:filename>', 'asset', send_asset)
+    app.session_interface = AssetSessionInterface()
+    app.jinja_env.globals.update(url_for=url_for, bundle_urls=bundle_urls)
@@ -1,89 +1,437 @@
-from datetime import datetime
-import os
+from datetime import datetime, timedelta, timezone
+import hashlib
+import hmac
+import random
+import secrets
 
-from flask import Blueprint, request, jsonify, send_file
+from flask import Blueprint, Response, current_app, request, jsonify, url_for
 from flask_login import current_user, login_required
-from sqlalchemy.sql.expression import func
-from sqlalchemy import nullslast
 
-from backend.model import db, Classification, Patch, Member, PATCH_DIR
+from backend import derivatives, leases, offload, summary
+from backend.database import insert
+from backend.model import db, Classification, Patch, Member
+from backend.pair_queue import pair_queue
+from backend.patch_store import patch_store
+from backend.scheduler import balanced_scheduler, count_ratings
 
 classification = Blueprint('classification', __name__)
 
+# most pairs a client can ask for at once. Clients ask for enough to cover
+# the answers they've queued but not yet sent, plus the ones to preload.
+MAX_PREFETCH = 20
 
-def get_classification():
+# most answers accepted in one request to /classification/batch
+MAX_BATCH = 100
+
+# how far a client's clock can run ahead of ours, and how long it can hold on
+# to an answer, before we ignore its timestamps
+MAX_CLOCK_SKEW = timedelta(minutes=5)
+MAX_CLIENT_DELAY = timedelta(days=1)
+
+
+def classification_count(u):
+    # read fresh each time, since the logged in user is a cached identity
+    return db.session.query(Member.num_classifications).filter_by(id=u.id).scalar()
+
+
+def pair_scheduler():
+    """Whichever of the sequential queue or balanced scheduler ``PAIR_SCHEDULER`` names."""
+    if current_app.config['PAIR_SCHEDULER'] == 'balanced':
+        return balanced_scheduler
+    return pair_queue
+
+
+def serve_pairs(u, count, page=None):
+    """The next ``count`` pairs for one of the user's pages, leased to it.
+
+    A page is given the pairs already leased to it first, so the ones it
+    has preloaded stay valid, then new pairs that skip every patch leased
+    to other users or to the user's other pages. If that leaves nothing,
+    pairs leased to the user's other pages come before other users'.
+
+    Leases are only written for new pairs, or ones over half way through
+    their lease, so asking again for the same pairs doesn't write anything.
+    """
+    scheduler = pair_scheduler()
+    held, leased, leased_to_others = leases.live(u.id, page)
+
+    pairs = [pair for pair, _ in held[:count]]
+    renew = [pair for pair, expires_at in held[:count] if leases.expiring(expires_at)]
+    new = []
+    if len(pairs) < count:
+        new = scheduler.next_pairs(u, count - len(pairs), leased)
+        if not new and not pairs:
+            new = scheduler.next_pairs(u, count, leased_to_others) or scheduler.next_pairs(u, count)
+
+    if new or renew:
+        leases.grant(u.id, page, renew + new)
+        db.session.commit()
+    return pairs + new
+
+
+def new_page():
+    """An id for a page being rendered, which its requests for more pairs send back."""
+    return secrets.token_hex(8)
+
+
+def page_id(value):
+    return value if isinstance(value, str) and len(value) <= 32 else None
+
+
+def get_classification(page):
     u = current_user
+
+    # the next pair of patches the user hasn't classified
+    pairs = serve_pairs(u, 1, page)
+    real_patch_id, fake_patch_id = pairs[0] if pairs else (None, None)
+
+    num_classifications = classification_count(u)
+
+    if real_patch_id is None or fake_patch_id is None:
+        return None, None, num_classifications
     
-    # get a real patch and a fake patch that the user hasn't classified with the
-    # smallest id
-    real_patch = (
-        db.session.query(Patch)
-        .filter_by(real=True)
-        .filter(~Patch.real_classifications.any(Classification.user_id == u.id))
-        .filter_by(version=1)
-        # order by id to get smallest id, and then by version to get the latest version
-        .order_by(nullslast(Patch.version.desc()), Patch.id)
-        .first()
+    return real_patch_id, fake_patch_id, num_classifications
+
+
+def patch_url(patch_id, patch_file, fmt, width=None):
+    # with PATCH_URL_SECRET set, link derived files straight to the web
+    # server, rather than through get_patch. Source files have the patch's
+    # class in their path, and packed ones don't have a file of their own,
+    # so they still go through the app.
+    if current_app.config['PATCH_URL_SECRET']:
+        variant_file = patch_store.variant(patch_file, fmt, width)
+        if offload.can_sign(variant_file):
+            return offload.signed_url(variant_file)
+    return url_for('classification.get_patch', id=patch_id, format=fmt, w=width)
+
+
+def patch_images(patch_ids):
+    """Build the ``src`` and ``srcset`` of each patch in a pair.
+
+    Both patches are always given the same format and widths, chosen from
+    what the browser accepts and what's been derived for both of them.
+    """
+    patch_files = [
+        patch_store.get(patch_id) if patch_id is not None else None
+        for patch_id in patch_ids
+    ]
+    if not all(patch_files):
+        return [dict(src=url_for('classification.get_patch', id=patch_id), srcset='') for patch_id in patch_ids]
+
+    fmt, widths = derivatives.pair_encoding(
+        [patch_store.variants(patch_file) for patch_file in patch_files],
+        request.accept_mimetypes,
     )
-    fake_patch = (
-        db.session.query(Patch)
-        .filter_by(real=False)
-        .filter(~Patch.fake_classifications.any(Classification.user_id == u.id))
-        .filter_by(version=1)
-        .order_by(nullslast(Patch.version.desc()), Patch.id)
-        .first()
+
+    images = []
+    for patch_id, patch_file in zip(patch_ids, patch_files):
+        src = patch_url(patch_id, patch_file, fmt)
+        srcset = [f'{patch_url(patch_id, patch_file, fmt, width)} {width}w' for width in widths]
+        entry = patch_store.derived(patch_file)
+        if fmt == 'png' and entry:
+            srcset.append(f"{src} {entry['width']}w")
+        images.append(dict(src=src, srcset=', '.join(srcset)))
+
+    return images
+
+
+def pair_token(user_id, real_patch_id, fake_patch_id):
+    """A token identifying a pair served to a user, sent back with the answer."""
+    message = f'{user_id}:{real_patch_id}:{fake_patch_id}'.encode()
+    return hmac.new(current_app.secret_key.encode(), message, hashlib.sha256).hexdigest()[:32]
+
+
+def tokenless_allowed():
+    """Whether answers without a token are still accepted, under ``PAIR_TOKEN_GRACE_UNTIL``."""
+    grace = current_app.config['PAIR_TOKEN_GRACE_UNTIL']
+    if not grace:
+        return False
+    until = datetime.fromisoformat(grace)
+    if until.tzinfo is None:
+        until = until.replace(tzinfo=timezone.utc)
+    return datetime.now(timezone.utc) < until
+
+
+def pair_view(real_patch_id, fake_patch_id):
+    """Everything the page needs to show a pair, in a random left/right order."""
+    patch1_id, patch2_id = real_patch_id, fake_patch_id
+    if random.random() > 0.5:
+        patch1_id, patch2_id = patch2_id, patch1_id
+
+    patch1, patch2 = patch_images([patch1_id, patch2_id])
+
+    return dict(
+        patch1_id=patch1_id,
+        patch2_id=patch2_id,
+        patch1=patch1,
+        patch2=patch2,
+        real_patch_id=real_patch_id,
+        fake_patch_id=fake_patch_id,
+        token=pair_token(current_user.id, real_patch_id, fake_patch_id),
+    )
+
+
+def client_timestamp(value):
+    """Parse a client's answer time (ms since the epoch), or None to use the server's."""
+    if value is None:
+        return None
+    try:
+        timestamp = datetime.fromtimestamp(float(value) / 1000, timezone.utc)
+    except (TypeError, ValueError, OverflowError, OSError):
+        return None
+
+    # answers can be queued on the client for a while, but anything from the
+    # future or from days ago means the client's clock can't be trusted
+    now = datetime.now(timezone.utc)
+    if timestamp > now + MAX_CLOCK_SKEW or timestamp < now - MAX_CLIENT_DELAY:
+        return None
+    return timestamp
+
+
+def save_classifications(u, records):
+    """Record a batch of a user's answers in one transaction.
+
+    ``records`` are (real_patch_id, fake_patch_id, classification, timestamp,
+    token) tuples, where the timestamp may be None to use the server's time
+    and the token must be the one the pair was served to the user with. Patch
+    ids are checked with a single query, and records that are missing data
+    or refer to unknown patches, or to a fake patch as the real one or the
+    other way round, are skipped. The user's running totals in
+    ``classification_summary`` are updated in the same transaction.
+
+    Each user can only answer a pair once, so answers to pairs they've
+    already answered, such as retries and double clicks, are accepted but
+    don't change anything.
+
+    Returns the number of records accepted and an error message for each one
+    that was skipped.
+    """
+    errors = []
+    valid = []
+    for real_patch_id, fake_patch_id, classification, timestamp, token in records:
+        if real_patch_id is None or fake_patch_id is None or not classification:
+            errors.append('Missing data')
+            continue
+        try:
+            real_patch_id, fake_patch_id = int(real_patch_id), int(fake_patch_id)
+        except (TypeError, ValueError):
+            errors.append('Invalid patch IDs')
+            continue
+        if token is None:
+            if not tokenless_allowed():
+                errors.append('Missing token')
+                continue
+        elif not hmac.compare_digest(str(token), pair_token(u.id, real_patch_id, fake_patch_id)):
+            errors.append('Invalid token')
+            continue
+        valid.append((real_patch_id, fake_patch_id, classification, timestamp))
+
+    patch_ids = {patch_id for (real_patch_id, fake_patch_id, _, _) in valid for patch_id in (real_patch_id, fake_patch_id)}
+    versions = {}
+    real_ids = set()
+    if patch_ids:
+        for patch_id, real, version in db.session.query(Patch.id, Patch.real, Patch.version).filter(Patch.id.in_(list(patch_ids))):
+            versions[patch_id] = version
+            if real:
+                real_ids.add(patch_id)
+
+    now = datetime.now(timezone.utc)
+    records = []
+    for real_patch_id, fake_patch_id, classification, timestamp in valid:
+        # both patches must exist, and be the kind they're claimed to be
+        if real_patch_id in real_ids and fake_patch_id in versions and fake_patch_id not in real_ids:
+            records.append((real_patch_id, fake_patch_id, classification, timestamp or now))
+        else:
+            errors.append('Invalid patch IDs')
+
+    if not records:
+        return 0, errors
+
+    # the first answer to a pair in the batch wins, like it does against
+    # answers already saved
+    first = {}
+    for record in records:
+        first.setdefault((record[0], record[1]), record)
+
+    inserted = insert_classifications([
+        dict(
+            real_patch_id=real_patch_id,
+            fake_patch_id=fake_patch_id,
+            user_id=u.id,
+            classification=classification == 'real',
+            timestamp=timestamp,
+        )
+        for (real_patch_id, fake_patch_id, classification, timestamp) in first.values()
+    ])
+    new_records = [first[pair] for pair in inserted]
+
+    summary.record(u.id, [
+        (versions[fake_patch_id], classification == 'real', timestamp)
+        for (_, fake_patch_id, classification, timestamp) in new_records
+    ])
+    # rating counts are kept under either scheduler, so switching to the
+    # balanced one starts from the right counts. The sequential cursor only
+    # ever falls behind, so it can be left until that scheduler is used,
+    # and catches up then.
+    count_ratings(inserted)
+    scheduler = pair_scheduler()
+    if scheduler is pair_queue:
+        pair_queue.advance(u)
+    # logged in users are cached, so this is also where a user deleted in
+    # the meantime is caught
+    members = Member.query.filter_by(id=u.id).update(
+        {Member.num_classifications: Member.num_classifications + len(new_records)}
     )
+    if not members:
+        db.session.rollback()
+        return 0, errors + ['Unknown user'] * len(first)
+    leases.settle(u.id, first)
+    db.session.commit()
+
+    if scheduler is balanced_scheduler:
+        balanced_scheduler.record(u, inserted)
+
+    return len(records), errors
 
-    # get the number of unique classifications the user has made
-    num_classifications = (
-        db.session.query(Classification)
-        .filter_by(user=u)
-        .group_by(Classification.real_patch_id, Classification.fake_patch_id)
-        .count()
+
+def insert_classifications(rows):
+    """Insert classifications, skipping any pair the user has already answered.
+
+    Returns the (real_patch_id, fake_patch_id) of each row inserted. The
+    skipping is left to the unique (user_id, real_patch_id, fake_patch_id)
+    index, so it holds across workers too.
+    """
+    statement = (
+        insert(db.session, Classification)
+        .values(rows)
+        .on_conflict_do_nothing(index_elements=['user_id', 'real_patch_id', 'fake_patch_id'])
+        .returning(Classification.real_patch_id, Classification.fake_patch_id)
     )
+    return [tuple(row) for row in db.session.execute(statement)]
 
-    if not real_patch or not fake_patch:
-        return None, None, num_classifications
-    
-    return real_patch, fake_patch, num_classifications
+
+def save_classification(u, real_patch_id, fake_patch_id, classification, token=None):
+    """Record a user's answer for a pair, returning an error message if it's invalid."""
+    if not real_patch_id or not fake_patch_id or not classification:
+        return 'Missing data'
+
+    current_app.logger.info('classification: %s %s %s', real_patch_id, fake_patch_id, classification)
+
+    _, errors = save_classifications(u, [(real_patch_id, fake_patch_id, classification, None, token)])
+    return errors[0] if errors else None
 
 
 @classification.route('/classification', methods=['POST'])
 @login_required
 def post_classification():
+    error = save_classification(
+        current_user,
+        request.form.get('real_patch_id'),
+        request.form.get('fake_patch_id'),
+        request.form.get('classification'),
+        request.form.get('token'),
+    )
+
+    if error:
+        return jsonify(
+            success=False,
+            message=error,
+        )
+
+    return jsonify(
+        success=True,
+    )
+
+
+@classification.route('/classification/next', methods=['GET', 'POST'])
+@login_required
+def next_classification():
+    """Optionally record an answer, then return the user's upcoming pairs.
+
+    The first pair returned is the one to show now and the rest are for the
+    page to preload, so the next pair can be shown as soon as it's answered.
+    Pages send their ``page`` id, so they're given back the pairs they
+    already have rather than ones another tab is showing.
+    """
     u = current_user
-    real_patch_id = request.form.get('real_patch_id')
-    fake_patch_id = request.form.get('fake_patch_id')
-    classification = request.form.get('classification')
 
-    if not real_patch_id or not fake_patch_id or not classification:
+    if request.method == 'POST':
+        error = save_classification(
+            u,
+            request.form.get('real_patch_id'),
+            request.form.get('fake_patch_id'),
+            request.form.get('classification'),
+            request.form.get('token'),
+        )
+
+        if error:
+            return jsonify(
+                success=False,
+                message=error,
+            )
+
+    count = min(max(request.values.get('count', 1, type=int), 1), MAX_PREFETCH)
+    page = page_id(request.values.get('page'))
+    pairs = [pair_view(real_patch_id, fake_patch_id) for real_patch_id, fake_patch_id in serve_pairs(u, count, page)]
+
+    return jsonify(
+        success=True,
+        num_classifications=classification_count(u),
+        pairs=pairs,
+    )
+
+
+@classification.route('/classification/batch', methods=['POST'])
+@login_required
+def post_classification_batch():
+    """Record a batch of answers queued by the client, then return its upcoming pairs.
+
+    Expects a JSON body with a ``classifications`` list, each having
+    ``real_patch_id``, ``fake_patch_id``, ``classification`` and optionally
+    ``client_timestamp`` in ms since the epoch and the pair's ``token``, and
+    an optional ``count`` of pairs to return and the ``page`` id, as for
+    /classification/next.
+    """
+    u = current_user
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        data = {}
+    records = data.get('classifications')
+
+    if not isinstance(records, list) or not all(isinstance(record, dict) for record in records):
         return jsonify(
             success=False,
             message='Missing data',
         )
 
-    real_patch = Patch.query.filter_by(id=real_patch_id).first()
-    fake_patch = Patch.query.filter_by(id=fake_patch_id).first()
-
-    if not real_patch or not fake_patch:
+    if len(records) > MAX_BATCH:
         return jsonify(
             success=False,
-            message='Invalid patch IDs',
+            message='Too many classifications',
         )
-    
-    print(real_patch_id, fake_patch_id, classification)
 
-    new_classification = Classification(
-        real_patch=real_patch,
-        fake_patch=fake_patch,
-        user=u,
-        classification=classification == 'real',
-    )
-    db.session.add(new_classification)
-    db.session.commit()
+    saved, errors = save_classifications(u, [
+        (
+            record.get('real_patch_id'),
+            record.get('fake_patch_id'),
+            record.get('classification'),
+            client_timestamp(record.get('client_timestamp')),
+            record.get('token'),
+        )
+        for record in records
+    ])
+
+    count = data.get('count', 1)
+    count = min(max(count, 1), MAX_PREFETCH) if isinstance(count, int) else 1
+    page = page_id(data.get('page'))
+    pairs = [pair_view(real_patch_id, fake_patch_id) for real_patch_id, fake_patch_id in serve_pairs(u, count, page)]
 
     return jsonify(
         success=True,
+        saved=saved,
+        rejected=len(errors),
+        num_classifications=classification_count(u),
+        pairs=pairs,
     )
 
 
@@ -92,33 +440,55 @@ def post_classification():
 def get_patch():
     patch_id = request.args.get('id', type=int)
 
-    if not patch_id:
+    if patch_id is None:
         return jsonify(
             success=False,
             message='Missing data',
         )
     
-    patch = Patch.query.filter_by(id=patch_id).first()
+    patch_file = patch_store.get(patch_id)
 
-    if not patch:
+    if not patch_file:
         return jsonify(
             success=False,
             message='Invalid patch ID',
         )
-    
-    if patch.real:
-        patch_id = patch_id // 2
-        path = os.path.join(PATCH_DIR, 'real', f'{patch_id}.png')
-        path_version = os.path.join(PATCH_DIR, 'real', f'{patch_id}_{patch.version}.png')
-        if os.path.exists(path_version):
-            path = path_version
+
+    # pages ask for an explicit format so both patches of a pair match, but
+    # fall back to negotiating on the Accept header for anything else
+    fmt = request.args.get('format')
+    negotiated = fmt is None
+    if negotiated:
+        fmt, _ = derivatives.pair_encoding([patch_store.variants(patch_file)], request.accept_mimetypes)
+    patch_file = patch_store.variant(patch_file, fmt, request.args.get('w', type=int))
+
+    # a patch's file only changes if it's re-sampled, which changes the etag,
+    # so browsers can keep it indefinitely and revalidate without a download
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains(patch_file.etag)
     else:
-        patch_id = (patch_id - 1) // 2
-        path = os.path.join(PATCH_DIR, 'fake', f'{patch_id}.png')
-        path_version = os.path.join(PATCH_DIR, 'fake', f'{patch_id}_{patch.version}.png')
-        if os.path.exists(path_version):
-            path = path_version
-    
-    return send_file(path)
+        not_modified = bool(request.if_modified_since) and request.if_modified_since >= patch_file.last_modified
 
-    
+    if not_modified:
+        response = Response(status=304)
+    elif current_app.config['PATCH_SENDFILE'] and not patch_file.packed:
+        response = offload.sendfile_response(patch_file)
+        response.last_modified = patch_file.last_modified
+    else:
+        try:
+            data = patch_store.read(patch_file)
+        except FileNotFoundError:
+            return jsonify(
+                success=False,
+                message='Invalid patch ID',
+            )
+        response = Response(data, mimetype=patch_file.mimetype)
+        response.last_modified = patch_file.last_modified
+    response.set_etag(patch_file.etag)
+    response.cache_control.private = True
+    response.cache_control.max_age = 365 * 24 * 60 * 60
+    response.cache_control.immutable = True
+    if negotiated:
+        response.vary.add('Accept')
+
+    return response
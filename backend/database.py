@@ -0,0 +1,67 @@
+import os
+import sqlite3
+
+from sqlalchemy import event
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine
+
+# pragmas applied to every sqlite connection. WAL lets readers carry on while
+# a classification is being written, and with synchronous=NORMAL a commit
+# doesn't wait for an fsync (the database is still never corrupted, a crash
+# can only lose the last few commits). busy_timeout makes concurrent writers
+# wait for the lock rather than fail straight away.
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+    'cache_size': -64 * 1024, # in KiB, so 64MiB
+    'temp_store': 'MEMORY',
+}
+
+
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for pragma, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f'PRAGMA {pragma}={value}')
+    cursor.close()
+
+
+def engine_options(uri):
+    """Connection pool settings for a database URI, overridable from the environment.
+
+    Each worker gets its own pool. sqlite only allows one writer at a time,
+    so a handful of connections is plenty, whereas a server database gets a
+    larger pool with connections checked and recycled so ones the server has
+    dropped aren't handed out.
+    """
+    if uri.startswith('sqlite') and (uri == 'sqlite://' or ':memory:' in uri):
+        # in-memory databases live in a single connection, so there's no pool
+        return {}
+    if uri.startswith('sqlite'):
+        options = dict(pool_size=5, max_overflow=5, pool_timeout=10)
+    else:
+        options = dict(pool_size=10, max_overflow=10, pool_timeout=10, pool_recycle=1800, pool_pre_ping=True)
+
+    for option, env in (
+        ('pool_size', 'DATABASE_POOL_SIZE'),
+        ('max_overflow', 'DATABASE_MAX_OVERFLOW'),
+        ('pool_timeout', 'DATABASE_POOL_TIMEOUT'),
+        ('pool_recycle', 'DATABASE_POOL_RECYCLE'),
+    ):
+        if os.environ.get(env):
+            options[option] = int(os.environ[env])
+
+    return options
+
+
+def insert(session, model):
+    """An INSERT for the session's database that supports ON CONFLICT clauses.
+
+    Both sqlite and PostgreSQL have them, under their own insert constructs.
+    """
+    if session.get_bind().dialect.name == 'postgresql':
+        return postgresql.insert(model)
+    return sqlite.insert(model)
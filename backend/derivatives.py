@@ -0,0 +1,128 @@
+import json
+from multiprocessing import Pool
+import os
+
+from backend.manifest import etag, manifest
+from backend.model import PATCH_DIR
+
+# Derived copies of every patch live in a content-addressed cache keyed by the
+# sha256 of the source file, so unchanged patches are never re-encoded and a
+# re-sampled patch can't be served a stale derivative.
+DERIVED_DIR = os.path.join(PATCH_DIR, 'derived')
+DERIVED_INDEX = os.path.join(DERIVED_DIR, 'index.json')
+
+# widths to downscale to, on top of the patch's own width
+WIDTHS = (512, 768)
+
+# formats we encode, in order of preference when a browser accepts several.
+# WebP is lossless so the study sees exactly the same pixels as the PNGs.
+FORMATS = ('webp',)
+
+MIMETYPES = {
+    'png': 'image/png',
+    'webp': 'image/webp',
+}
+
+
+def derived_path(digest, width, fmt):
+    return os.path.join(DERIVED_DIR, digest[:2], f'{digest}_{width}.{fmt}')
+
+
+def _encode(image, path, fmt):
+    tmp_path = path + '.tmp'
+    if fmt == 'webp':
+        image.save(tmp_path, 'WEBP', lossless=True)
+    else:
+        image.save(tmp_path, 'PNG', optimize=True)
+    os.replace(tmp_path, path)
+
+
+def _build_one(args):
+    from PIL import Image
+
+    relpath, entry = args
+    digest = entry['sha256']
+    path = os.path.join(PATCH_DIR, relpath)
+
+    with Image.open(path) as image:
+        image.load()
+        native_width = image.width
+        variants = []
+        for width in (native_width,) + WIDTHS:
+            if width > native_width:
+                continue
+            if width == native_width:
+                resized = image
+            else:
+                height = round(image.height * width / native_width)
+                resized = image.resize((width, height), Image.LANCZOS)
+
+            for fmt in FORMATS + ('png',):
+                # the source file is already the native-width png
+                if fmt == 'png' and width == native_width:
+                    continue
+                variants.append([fmt, width])
+                out = derived_path(digest, width, fmt)
+                if os.path.exists(out):
+                    continue
+                os.makedirs(os.path.dirname(out), exist_ok=True)
+                _encode(resized, out, fmt)
+
+    # the etag of the source lets the server spot derivatives that are stale
+    # because the patch was overwritten after the last build
+    source_etag = etag(entry['size'], entry['mtime_ns'])
+    return relpath, {'sha256': digest, 'etag': source_etag, 'width': native_width, 'variants': variants}
+
+
+def load_index():
+    try:
+        with open(DERIVED_INDEX) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def build(processes=None):
+    """Encode every patch into the derived cache using a pool of processes.
+
+    Returns the new index, which maps each patch file (relative to
+    ``PATCH_DIR``) to its checksum, native width and the (format, width)
+    variants available for it.
+    """
+    # checksums come from the manifest, so patches are only read to encode them
+    manifest.load(verify=True)
+    entries = sorted(manifest.entries())
+
+    os.makedirs(DERIVED_DIR, exist_ok=True)
+    with Pool(processes) as pool:
+        index = dict(pool.imap_unordered(_build_one, entries, chunksize=16))
+
+    tmp_path = DERIVED_INDEX + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, DERIVED_INDEX)
+
+    return index
+
+
+def pair_encoding(variants, accept_mimetypes):
+    """Choose one format and set of widths to serve both patches of a pair in.
+
+    ``variants`` holds the available (format, width) pairs for each patch.
+    Only encodings that exist for every patch are considered, so the real
+    and fake patch are always served identically and neither can be told
+    apart by its compression.
+
+    Returns the format and the widths it's available in. For png the
+    patch's own width is always available too, as the source file.
+    """
+    common = set.intersection(*(set(map(tuple, v)) for v in variants))
+    # only trust browsers that name the format, since image/* is also sent by
+    # browsers that can't decode it
+    accepted = {value for value, quality in accept_mimetypes if quality}
+    for fmt in FORMATS:
+        widths = sorted(width for (f, width) in common if f == fmt)
+        if widths and MIMETYPES[fmt] in accepted:
+            return fmt, widths
+
+    return 'png', sorted(width for (f, width) in common if f == 'png')
@@ -0,0 +1,24 @@
+from flask import current_app
+
+# An experiment is a patch version being rated. Several can run side by
+# side, each getting a share of the ratings in proportion to its weight.
+
+
+def parse_versions(value):
+    """Parse active versions and weights, e.g. '1,2:0.5' gives {1: 1.0, 2: 0.5}."""
+    versions = {}
+    for item in value.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        version, _, weight = item.partition(':')
+        weight = float(weight) if weight else 1.0
+        if weight <= 0:
+            raise ValueError(f'version {version} needs a positive weight, got {weight}')
+        versions[int(version)] = weight
+    return versions
+
+
+def active_versions():
+    """Map each version being served to its traffic weight."""
+    return current_app.config['EXPERIMENT_VERSIONS']
@@ -0,0 +1,149 @@
+import csv
+import io
+
+from backend.model import db, Classification, Member, Patch
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    # only needed to export to parquet
+    pa = pq = None
+
+# Full classification exports for offline analysis. Rows are read from the
+# database and written out a batch at a time, so memory use stays flat
+# however many classifications there are.
+
+COLUMNS = ('id', 'user_id', 'username', 'real_patch_id', 'fake_patch_id', 'version', 'classification', 'timestamp')
+
+FORMATS = {
+    'csv': 'text/csv',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+BATCH_SIZE = 10000
+
+
+def classification_rows(username=None, batch_size=BATCH_SIZE):
+    """Query every classification with its member and fake patch version, in id order.
+
+    Rows are fetched ``batch_size`` at a time, using a server side cursor
+    where the database supports one, instead of all at once.
+    """
+    query = (
+        db.session.query(
+            Classification.id,
+            Classification.user_id,
+            Member.username,
+            Classification.real_patch_id,
+            Classification.fake_patch_id,
+            Patch.version,
+            Classification.classification,
+            Classification.timestamp,
+        )
+        .outerjoin(Member, Member.id == Classification.user_id)
+        .outerjoin(Patch, Patch.id == Classification.fake_patch_id)
+        .order_by(Classification.id)
+    )
+    if username is not None:
+        query = query.filter(Member.username == username)
+    return query.yield_per(batch_size)
+
+
+def _batches(rows, batch_size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _record(row):
+    classification_id, user_id, username, real_patch_id, fake_patch_id, version, classification, timestamp = row
+    # stored as whether the user picked the real patch
+    return (
+        classification_id, user_id, username, real_patch_id, fake_patch_id, version,
+        'real' if classification else 'fake',
+        timestamp,
+    )
+
+
+def csv_chunks(rows, batch_size=BATCH_SIZE):
+    """Yield the rows as CSV, encoded, one chunk per batch after the header."""
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(COLUMNS)
+    yield out.getvalue().encode()
+
+    for batch in _batches(rows, batch_size):
+        out.seek(0)
+        out.truncate()
+        writer.writerows(_record(row) for row in batch)
+        yield out.getvalue().encode()
+
+
+class _Chunks(io.RawIOBase):
+    """A write-only file that hands back whatever's been written since it was last drained."""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def parquet_chunks(rows, batch_size=BATCH_SIZE):
+    """Yield a Parquet file of the rows, one chunk per row group of ``batch_size`` rows."""
+    schema = pa.schema([
+        ('id', pa.int64()),
+        ('user_id', pa.int64()),
+        ('username', pa.string()),
+        ('real_patch_id', pa.int64()),
+        ('fake_patch_id', pa.int64()),
+        ('version', pa.int64()),
+        ('classification', pa.string()),
+        ('timestamp', pa.timestamp('us')),
+    ])
+    sink = _Chunks()
+    with pq.ParquetWriter(sink, schema) as writer:
+        for batch in _batches(rows, batch_size):
+            columns = zip(*(_record(row) for row in batch))
+            writer.write_table(pa.Table.from_arrays(
+                [pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+                schema=schema,
+            ))
+            yield sink.drain()
+    # the footer is written on close
+    yield sink.drain()
+
+
+def export_chunks(fmt, rows, batch_size=BATCH_SIZE):
+    """Return a generator of the rows written out in ``fmt``, either 'csv' or 'parquet'.
+
+    Raises ValueError straight away, rather than once the export has
+    started, if the format isn't supported.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f'Unknown export format {fmt}')
+    if fmt == 'parquet' and pa is None:
+        raise ValueError('Exporting to parquet needs pyarrow installed')
+
+    chunks = csv_chunks if fmt == 'csv' else parquet_chunks
+    return chunks(rows, batch_size)
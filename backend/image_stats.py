@@ -0,0 +1,209 @@
+from dataclasses import dataclass
+from multiprocessing import Pool
+import os
+
+import numpy as np
+
+from backend.manifest import DIRECTORIES, manifest
+from backend.model import PATCH_DIR
+
+# Cheap automated realism signals to go alongside the human study. Every
+# patch gets a feature vector of colour and stain histograms, texture
+# statistics and its frequency spectrum, cached as a .npy file keyed by the
+# patch's sha256 so unchanged patches are never recomputed. Each version's
+# fake patches are then compared against the real ones.
+
+# bump when the features change, so old caches aren't mixed with new ones
+FEATURES_VERSION = 1
+STATS_DIR = os.path.join(PATCH_DIR, 'stats', f'v{FEATURES_VERSION}')
+
+BINS = 32
+
+# optical density range covered by the stain histograms
+MAX_OPTICAL_DENSITY = 3.0
+
+# Ruifrok and Johnston's haematoxylin, eosin and DAB stain vectors, for
+# unmixing each pixel's optical density into stain concentrations
+STAIN_VECTORS = np.array([
+    [0.65, 0.70, 0.29],
+    [0.07, 0.99, 0.11],
+    [0.27, 0.57, 0.78],
+])
+UNMIX = np.linalg.inv(STAIN_VECTORS / np.linalg.norm(STAIN_VECTORS, axis=1, keepdims=True))
+
+TEXTURE = ('contrast', 'gradient_mean', 'gradient_std', 'laplacian_var')
+
+# where each group of features sits in the vector
+FEATURES = {
+    'colour': slice(0, 3 * BINS),
+    'stain': slice(3 * BINS, 5 * BINS),
+    'texture': slice(5 * BINS, 5 * BINS + len(TEXTURE)),
+    'spectrum': slice(5 * BINS + len(TEXTURE), 6 * BINS + len(TEXTURE)),
+}
+NUM_FEATURES = 6 * BINS + len(TEXTURE)
+
+
+def stats_path(digest):
+    return os.path.join(STATS_DIR, digest[:2], f'{digest}.npy')
+
+
+def patch_features(rgb):
+    """Compute the feature vector for an RGB patch, as a (height, width, 3) uint8 array."""
+    pixels = rgb.reshape(-1, 3)
+    n = len(pixels)
+
+    # per channel intensity histograms
+    binned = pixels.astype(np.int64) * BINS // 256
+    colour = np.concatenate([np.bincount(binned[:, c], minlength=BINS) for c in range(3)]) / n
+
+    # haematoxylin and eosin concentration histograms
+    optical_density = -np.log((pixels + 1.0) / 256)
+    concentrations = optical_density @ UNMIX
+    stain_bins = np.clip((concentrations[:, :2] / MAX_OPTICAL_DENSITY * BINS).astype(np.int64), 0, BINS - 1)
+    stain = np.concatenate([np.bincount(stain_bins[:, s], minlength=BINS) for s in range(2)]) / n
+
+    grey = rgb @ np.array([0.299, 0.587, 0.114])
+    gy, gx = np.gradient(grey)
+    gradient = np.hypot(gx, gy)
+    laplacian = (
+        4 * grey[1:-1, 1:-1]
+        - grey[:-2, 1:-1] - grey[2:, 1:-1] - grey[1:-1, :-2] - grey[1:-1, 2:]
+    )
+    texture = np.array([grey.std(), gradient.mean(), gradient.std(), laplacian.var()])
+
+    # share of the power in each radial frequency band
+    power = np.abs(np.fft.rfft2(grey - grey.mean())) ** 2
+    fy = np.fft.fftfreq(grey.shape[0])[:, None]
+    fx = np.fft.rfftfreq(grey.shape[1])[None, :]
+    bands = np.minimum((np.hypot(fy, fx) / 0.5 * BINS).astype(np.int64), BINS - 1)
+    spectrum = np.bincount(bands.ravel(), weights=power.ravel(), minlength=BINS)
+    spectrum /= spectrum.sum() or 1
+
+    return np.concatenate([colour, stain, texture, spectrum]).astype(np.float32)
+
+
+def _compute_one(args):
+    from PIL import Image
+
+    relpath, digest = args
+    with Image.open(os.path.join(PATCH_DIR, relpath)) as image:
+        rgb = np.asarray(image.convert('RGB'))
+
+    path = stats_path(digest)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp.npy'
+    np.save(tmp_path, patch_features(rgb))
+    os.replace(tmp_path, path)
+    return relpath
+
+
+def compute(processes=None):
+    """Compute and cache the features of every patch that isn't cached yet.
+
+    Patches are streamed through a pool of processes, so only a chunk of
+    them is ever in memory. Returns how many were computed.
+    """
+    manifest.load(verify=True)
+    todo = [
+        (relpath, entry['sha256'])
+        for relpath, entry in sorted(manifest.entries())
+        if not os.path.exists(stats_path(entry['sha256']))
+    ]
+    if todo:
+        with Pool(processes) as pool:
+            for _ in pool.imap_unordered(_compute_one, todo, chunksize=8):
+                pass
+    return len(todo)
+
+
+def load_features():
+    """Load the cached features, as {(real, version): (n, NUM_FEATURES) array}."""
+    paths = {}
+    for real in DIRECTORIES:
+        for entry in manifest.files(real).values():
+            paths.setdefault((real, entry['version']), []).append(stats_path(entry['sha256']))
+
+    return {
+        key: np.stack([np.load(path) for path in group_paths])
+        for key, group_paths in paths.items()
+    }
+
+
+def _js_divergence(p, q):
+    """Jensen-Shannon divergence (in bits) between histograms along the last axis."""
+    p = p / p.sum(axis=-1, keepdims=True)
+    q = q / q.sum(axis=-1, keepdims=True)
+    m = (p + q) / 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        kl_p = np.where(p > 0, p * np.log2(p / m), 0).sum(axis=-1)
+        kl_q = np.where(q > 0, q * np.log2(q / m), 0).sum(axis=-1)
+    return (kl_p + kl_q) / 2
+
+
+def _wasserstein(a, b, quantiles=np.linspace(0, 1, 101)):
+    """1-D earth mover's distance between the samples in each column of ``a`` and ``b``."""
+    return np.abs(np.quantile(a, quantiles, axis=0) - np.quantile(b, quantiles, axis=0)).mean(axis=0)
+
+
+@dataclass
+class Distances:
+    num_real: int
+    num_fake: int
+    # Jensen-Shannon divergence of the mean histograms, averaged over
+    # channels or stains
+    colour: float
+    stain: float
+    spectrum: float
+    # earth mover's distance of each texture statistic, in units of the real
+    # patches' standard deviation, averaged over the statistics
+    texture: float
+
+
+def distances(real, fake):
+    """Compare feature arrays of real and fake patches."""
+    colour = _js_divergence(
+        real[:, FEATURES['colour']].mean(axis=0).reshape(3, BINS),
+        fake[:, FEATURES['colour']].mean(axis=0).reshape(3, BINS),
+    ).mean()
+    stain = _js_divergence(
+        real[:, FEATURES['stain']].mean(axis=0).reshape(2, BINS),
+        fake[:, FEATURES['stain']].mean(axis=0).reshape(2, BINS),
+    ).mean()
+    spectrum = _js_divergence(
+        real[:, FEATURES['spectrum']].mean(axis=0),
+        fake[:, FEATURES['spectrum']].mean(axis=0),
+    )
+
+    real_texture = real[:, FEATURES['texture']].astype(np.float64)
+    fake_texture = fake[:, FEATURES['texture']].astype(np.float64)
+    scale = real_texture.std(axis=0)
+    scale[scale == 0] = 1
+    texture = (_wasserstein(real_texture, fake_texture) / scale).mean()
+
+    return Distances(
+        num_real=len(real),
+        num_fake=len(fake),
+        colour=float(colour),
+        stain=float(stain),
+        spectrum=float(spectrum),
+        texture=float(texture),
+    )
+
+
+def version_distances():
+    """Compare each version's fake patches against the real ones, returning {version: Distances}.
+
+    Fakes are compared against the real patches of the same version where
+    there are any, and against every real patch otherwise.
+    """
+    features = load_features()
+    reals = [array for (real, _), array in features.items() if real]
+    if not reals:
+        return {}
+    all_real = np.concatenate(reals)
+
+    return {
+        version: distances(features.get((True, version), all_real), fake)
+        for (real, version), fake in sorted(features.items())
+        if not real
+    }
@@ -0,0 +1,121 @@
+from datetime import datetime, timedelta, timezone
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy import tuple_
+
+from backend.database import insert
+from backend.model import db, PairLease
+
+# Every pair served is leased to the user and page it was served to for
+# PAIR_LEASE_SECONDS. Other users, and the user's other pages such as other
+# tabs, aren't given its patches while the lease is live, so raters working
+# at the same time, through any worker, spread out over the least rated
+# patches rather than all being handed the same ones. Answering a pair
+# settles its lease, and abandoned leases just expire.
+
+# expired leases are deleted at most this often by each worker
+RECLAIM_SECONDS = 60
+
+# most live leases read for each request. There are normally only a few per
+# active rater, so this just caps the cost if something goes wrong, at the
+# price of the odd patch being served twice.
+MAX_LEASES = 1000
+
+_reclaim_lock = threading.Lock()
+_last_reclaimed = 0
+
+
+def _now():
+    # stored naive, in UTC, like the classification timestamps
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def live(user_id, page):
+    """Read the live leases as seen by one of a user's pages.
+
+    Returns the pairs leased to the page, each with its expiry, and two
+    pairs of sets of real and fake patch ids: those leased to anyone, and
+    those leased to other users. The user's own leases are read through the
+    primary key and everyone else's through the expiry index, newest first.
+    """
+    now = _now()
+    own = (
+        db.session.query(PairLease.real_patch_id, PairLease.fake_patch_id, PairLease.page, PairLease.expires_at)
+        .filter(PairLease.user_id == user_id)
+        .filter(PairLease.expires_at > now)
+        .order_by(PairLease.expires_at, PairLease.real_patch_id)
+        .limit(MAX_LEASES)
+    )
+    others = (
+        db.session.query(PairLease.real_patch_id, PairLease.fake_patch_id)
+        .filter(PairLease.expires_at > now)
+        .filter(PairLease.user_id != user_id)
+        .order_by(PairLease.expires_at.desc())
+        .limit(MAX_LEASES)
+    )
+
+    held = []
+    leased = (set(), set())
+    for real_patch_id, fake_patch_id, lease_page, expires_at in own:
+        if lease_page == page:
+            held.append(((real_patch_id, fake_patch_id), expires_at))
+        leased[0].add(real_patch_id)
+        leased[1].add(fake_patch_id)
+
+    leased_to_others = (set(), set())
+    for real_patch_id, fake_patch_id in others:
+        leased_to_others[0].add(real_patch_id)
+        leased_to_others[1].add(fake_patch_id)
+        leased[0].add(real_patch_id)
+        leased[1].add(fake_patch_id)
+
+    return held, leased, leased_to_others
+
+
+def grant(user_id, page, pairs):
+    """Lease (real, fake) pairs to one of a user's pages, renewing any they already hold. The caller commits."""
+    pairs = list(dict.fromkeys(pairs))
+    if not pairs:
+        return
+
+    expires_at = _now() + timedelta(seconds=current_app.config['PAIR_LEASE_SECONDS'])
+    statement = insert(db.session, PairLease).values([
+        dict(user_id=user_id, real_patch_id=real_patch_id, fake_patch_id=fake_patch_id, page=page, expires_at=expires_at)
+        for real_patch_id, fake_patch_id in pairs
+    ])
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=['user_id', 'real_patch_id', 'fake_patch_id'],
+        set_=dict(page=statement.excluded.page, expires_at=statement.excluded.expires_at),
+    ))
+    reclaim()
+
+
+def expiring(expires_at):
+    """Whether a lease is over half way through, and worth renewing when it's served again."""
+    return expires_at - _now() < timedelta(seconds=current_app.config['PAIR_LEASE_SECONDS'] / 2)
+
+
+def settle(user_id, pairs):
+    """Release a user's leases on (real, fake) pairs they've answered. The caller commits."""
+    pairs = list(pairs)
+    if not pairs:
+        return
+    (
+        db.session.query(PairLease)
+        .filter(PairLease.user_id == user_id)
+        .filter(tuple_(PairLease.real_patch_id, PairLease.fake_patch_id).in_(pairs))
+        .delete(synchronize_session=False)
+    )
+
+
+def reclaim(force=False):
+    """Delete expired leases, at most once every ``RECLAIM_SECONDS`` unless forced. The caller commits."""
+    global _last_reclaimed
+    with _reclaim_lock:
+        if not force and time.monotonic() - _last_reclaimed < RECLAIM_SECONDS:
+            return
+        _last_reclaimed = time.monotonic()
+
+    PairLease.query.filter(PairLease.expires_at <= _now()).delete(synchronize_session=False)
@@ -1,12 +1,20 @@
+import os
+
 from backend.index import app
-from collections import defaultdict
+from backend import assets, derivatives, export, image_stats, packs, scheduler, stats
+from backend.experiments import active_versions
+from backend.manifest import get_id_version, manifest
 from backend.model import *
+from backend.pair_queue import mark_synced, pair_queue
+from backend.patch_store import patch_store
 from werkzeug.security import generate_password_hash
-import statistics
 
 
 def delete_all():
     with app.app_context():
+        PairCursor.query.delete()
+        PairLease.query.delete()
+        ClassificationSummary.query.delete()
         Classification.query.delete()
         Patch.query.delete()
         Member.query.delete()
@@ -22,9 +30,14 @@ def delete_user(username):
     with app.app_context():
         user = Member.query.filter_by(username=username).first()
         if user:
+            PairCursor.query.filter_by(user_id=user.id).delete()
+            PairLease.query.filter_by(user_id=user.id).delete()
+            ClassificationSummary.query.filter_by(user_id=user.id).delete()
             Classification.query.filter_by(user=user).delete()
             db.session.delete(user)
+            scheduler.recount_ratings()
             db.session.commit()
+            mark_synced()
 
 
 def add_user(username, password, hash=True):
@@ -42,48 +55,158 @@ def add_user(username, password, hash=True):
         db.session.commit()
 
 
-def get_id_version(filename):
-    filename = filename.split('.')[0]
-    id_version = filename.split('_')
-    if len(id_version) == 2:
-        patch_id = int(id_version[0])
-        version = int(id_version[1])
-    else:
-        patch_id = int(id_version[0])
-        version = 0
-    
-    return patch_id, version
+def scan_patches():
+    """Map each patch id to (real, version) from the patch manifest and packs.
+
+    Where a patch has several files, the highest version wins, matching the
+    file ``get_patch`` serves for it.
+    """
+    # stat every file so patches overwritten in place are picked up too
+    manifest.load(verify=True)
+
+    # packed patches count too, since their loose files may be gone
+    files = [(real, entry['id'], entry['version']) for real in (True, False) for entry in manifest.files(real).values()]
+    for (real, version), pack in packs.load_packs().items():
+        files += [(real, int(file_id), version) for file_id in pack.index['id']]
+
+    patches = {}
+    for real, file_id, version in files:
+        # real and fake patches share an id space: real ids are even and
+        # fake ids are odd
+        patch_id = file_id * 2 if real else file_id * 2 + 1
+        if patch_id not in patches or version > patches[patch_id][1]:
+            patches[patch_id] = (real, version)
+    return patches
+
 
+def initialise_patches(force=False, chunk_size=5000):
+    """Sync the patch table with the patch directories.
 
-def initialise_patches(force=False):
+    Existing patches are fetched in one query and diffed against a scan of
+    the directories, then new patches are inserted and changed versions
+    updated in chunks, so re-running it on an unchanged set does nothing.
+    """
     with app.app_context():
         if force:
             Patch.query.delete()
             db.session.commit()
 
-        for patch in REAL_PATCHES:
-            # get id from filename without extension
-            patch_id, version = get_id_version(patch)
-            patch_id = patch_id * 2
-            # check if patch already exists
-            if Patch.query.filter_by(id=patch_id).first():
-                continue
-            # add patch to database
-            new_patch = Patch(id=patch_id, real=True, version=version)
-            print(new_patch.id, new_patch.real, new_patch.version)
-            db.session.add(new_patch)
-        
-        for patch in FAKE_PATCHES:
-            patch_id, version = get_id_version(patch)
-            patch_id = patch_id * 2 + 1
-            if Patch.query.filter_by(id=patch_id).first():
-                continue
-            new_patch = Patch(id=patch_id, real=False, version=version)
-            print(new_patch.id, new_patch.real, new_patch.version)
-            db.session.add(new_patch)
-        
+        patches = scan_patches()
+        existing = {
+            patch_id: (real, version)
+            for patch_id, real, version in db.session.query(Patch.id, Patch.real, Patch.version)
+        }
+
+        new_patches = [
+            dict(id=patch_id, real=real, version=version)
+            for patch_id, (real, version) in sorted(patches.items())
+            if patch_id not in existing
+        ]
+        changed_patches = [
+            dict(id=patch_id, version=version)
+            for patch_id, (real, version) in sorted(patches.items())
+            if patch_id in existing and existing[patch_id][1] != version
+        ]
+        missing = len(existing.keys() - patches.keys())
+
+        for i in range(0, len(new_patches), chunk_size):
+            db.session.bulk_insert_mappings(Patch, new_patches[i:i + chunk_size])
+        for i in range(0, len(changed_patches), chunk_size):
+            db.session.bulk_update_mappings(Patch, changed_patches[i:i + chunk_size])
+
+        # patches that weren't being served before may come before where
+        # users have got to in the sequential queue
+        active = active_versions()
+        newly_servable = [
+            (patch_id, real)
+            for patch_id, (real, version) in patches.items()
+            if version in active and (patch_id not in existing or existing[patch_id][1] not in active)
+        ]
+        pair_queue.rewind(
+            min((patch_id for patch_id, real in newly_servable if real), default=None),
+            min((patch_id for patch_id, real in newly_servable if not real), default=None),
+        )
+        if force:
+            # every patch was inserted again, with no ratings
+            scheduler.recount_ratings()
         db.session.commit()
 
+        print(len(new_patches), 'patches added,', len(changed_patches), 'versions updated,', len(existing) - len(changed_patches) - missing, 'unchanged')
+        if missing:
+            print(missing, 'patches in the database have no file')
+
+        # workers reload their pools once they see this
+        mark_synced()
+        pair_queue.reset()
+        scheduler.balanced_scheduler.reset()
+        patch_store.reset()
+
+
+def build_derivatives(processes=None):
+    # encode lossless webp and downscaled copies of every patch, using all
+    # cores by default. Only new or changed patches are re-encoded.
+    index = derivatives.build(processes)
+    print(len(index), 'patches in the derived cache')
+    patch_store.reset()
+
+
+def simulate_scheduler(num_patches=1000, versions=(1,), num_raters=20, target=0.05, runs=5):
+    # compare how many ratings each scheduler needs before every version's
+    # score is known to within +/- target
+    results = {}
+    for strategy in scheduler.SIMULATED_POOLS:
+        needed = [
+            scheduler.simulate(strategy, num_patches, versions, num_raters, target, seed=seed)
+            for seed in range(runs)
+        ]
+        reached = [n for n in needed if n is not None]
+        results[strategy] = sum(reached) / len(reached) if reached else None
+        print(strategy, ':', len(reached), 'of', runs, 'runs reached the target, taking', results[strategy], 'ratings on average')
+    return results
+
+
+def evaluate_patches(processes=None):
+    # automated realism signals per version, alongside the human study.
+    # Features are cached by checksum, so re-runs only process new or
+    # changed patches.
+    computed = image_stats.compute(processes)
+    print(computed, 'patches evaluated')
+
+    results = image_stats.version_distances()
+    for version, d in results.items():
+        print("distances for version", version, "(" + str(d.num_fake), "fake against", d.num_real, "real patches):")
+        print("colour:", d.colour, "stain:", d.stain, "spectrum:", d.spectrum, "texture:", d.texture)
+    return results
+
+
+def build_packs():
+    # pack the loose patch files into one file per directory and version.
+    # Loose files are still served where they're newer than the pack, so
+    # they can be deleted once verify_packs() finds no problems.
+    built = packs.build()
+    for path, count in built.items():
+        print(path, ':', count, 'patches')
+    patch_store.reset()
+
+
+def verify_packs():
+    problems = packs.verify()
+    for problem in problems:
+        print(problem)
+    print(len(problems), 'problems found')
+    return not problems
+
+
+def build_assets(download=True):
+    # vendor the third party styles and fonts, then build the fingerprinted,
+    # precompressed static files. Vendored files are only downloaded once,
+    # so later builds work offline.
+    if download:
+        for name in assets.vendor():
+            print('downloaded', name)
+    built = assets.build()
+    print(len(built['files']), 'static files built into', assets.DIST_DIR)
+
 
 def list_classifications(username):
     with app.app_context():
@@ -92,95 +215,66 @@ def list_classifications(username):
             print('User does not exist')
             return
 
-        classifications = Classification.query.filter_by(user=user).all()
-        for classification in classifications:
-            print(classification.classification, classification.timestamp, "real patch id:", classification.real_patch_id, "fake patch id:", classification.fake_patch_id, "fake patch version:", classification.fake_patch.version)
-
-
-def calc_time_med(cs):
-    times = [c.timestamp for c in cs]
-    # how long it took the user to complete the later (j'th) classification
-    time_diff = [((j-i).total_seconds(), idx) for (i, (idx, j)) in zip(times, enumerate(times[1:]))]
-    # assume nobody will take longer than 5 mins per image
-    time_diff = [(diff, idx) for (diff, idx) in time_diff if diff < 5 * 60]
-
-    time_diff_correct = [diff for (diff, idx) in time_diff if cs[idx].classification]
-    time_diff_incorrect = [diff for (diff, idx) in time_diff if not cs[idx].classification]
-    time_diff = [diff for (diff, idx) in time_diff]
+        for row in export.classification_rows(username):
+            _, _, _, real_patch_id, fake_patch_id, version, classification, timestamp = row
+            print(classification, timestamp, "real patch id:", real_patch_id, "fake patch id:", fake_patch_id, "fake patch version:", version)
 
-    correct_med = -1 if len(time_diff_correct) == 0 else statistics.median(time_diff_correct)
-    incorrect_med = -1 if len(time_diff_incorrect) == 0 else statistics.median(time_diff_incorrect)
-    med = -1 if len(time_diff) == 0 else statistics.median(time_diff)
 
-    return med, correct_med, incorrect_med
+def export_classifications(path, fmt=None, username=None):
+    """Write every classification, or just one user's, to ``path`` as CSV or Parquet.
 
-def calc_classification_stats(classifications):
-    classifications.sort(key=lambda x: x.timestamp)
-
-    correct_classifications = [c for c in classifications if c.classification]
-    incorrect_classifications = [c for c in classifications if not c.classification]
-
-    num_correct = len(correct_classifications)
-    num_incorrect = len(incorrect_classifications)
-
-    total = num_correct + num_incorrect
-    score = num_incorrect / total
-
-    time_med, correct_time_med, incorrect_time_med = calc_time_med(classifications)
-
-    return total, num_correct, num_incorrect, score, abs(score - 0.5), time_med, correct_time_med, incorrect_time_med
+    The format is taken from the file extension unless ``fmt`` is given.
+    """
+    fmt = fmt or os.path.splitext(path)[1].lstrip('.')
+    with app.app_context():
+        with open(path, 'wb') as f:
+            for chunk in export.export_chunks(fmt, export.classification_rows(username)):
+                f.write(chunk)
 
 
-def show_classification_stats():
-    TEST_USERS = ['jameshball', 'noor']
+def show_classification_stats(fmt='text', path=None):
+    """Print accuracy and timing stats per user and version.
 
+    With ``fmt`` as 'json' or 'csv' the full report is written to ``path``
+    (or printed) in that format instead.
+    """
     with app.app_context():
-        users = Member.query.all()
-        all_users_versions = defaultdict(list)
-        all_classifications = []
-        all_error_versions = defaultdict(list)
-        for user in users:
-            print("statistics for", user.username)
-            classifications = Classification.query.filter_by(user=user).all()
-            if user.username not in TEST_USERS:
-                all_classifications += classifications
-            versions = defaultdict(list)
-
-            for classification in classifications:
-                version = classification.fake_patch.version
-                version = 0 if version is None else version
-                versions[version].append(classification)
-
-            user_error = []
-            for version in versions.keys():
-                total, num_correct, num_incorrect, score, error, med_time, correct_med_time, incorrect_med_time = calc_classification_stats(versions[version])
-                if user.username not in TEST_USERS:
-                    all_users_versions[version] += versions[version]
-                    all_error_versions[version].append((error, total))
-                print("stats for version", version, ":")
-                print(total, "images classified total:", num_correct, "correct, and", num_incorrect, "incorrect:", score, "absolute error:", error, "median time:", med_time, "median time when correct:", correct_med_time, "median time when incorrect:", incorrect_med_time)
-
-            total, num_correct, num_incorrect, score, error, med_time, correct_med_time, incorrect_med_time = calc_classification_stats(classifications)
-            print("overall stats")
-            print(total, "images classified total:", num_correct, "correct, and", num_incorrect, "incorrect:", score, "median time:", med_time, "median time when correct:", correct_med_time, "median time when incorrect:", incorrect_med_time)
-            print()
-
-        print("-----------------------")
-        print("overall statistics for all (production) users")
-        print("-----------------------")
-        for version in all_users_versions.keys():
-            total, num_correct, num_incorrect, score, error, med_time, correct_med_time, incorrect_med_time = calc_classification_stats(all_users_versions[version])
-            weighted_abs = [num_classified * abs_error / total for abs_error, num_classified in all_error_versions[version]]
-            version_mae = sum(weighted_abs)
+        report = stats.classification_stats(exclude_users=app.config['TEST_USERS'])
+
+    if fmt != 'text':
+        output = report.to_json() if fmt == 'json' else report.to_csv()
+        if path:
+            with open(path, 'w') as f:
+                f.write(output)
+        else:
+            print(output)
+        return report
+
+    for username, versions in report.user_versions.items():
+        print("statistics for", username)
+        for version, s in versions.items():
             print("stats for version", version, ":")
-            print(total, "images classified total:", num_correct, "correct, and", num_incorrect, "incorrect:", score, "MEAN WEIGHTED ABS ERROR:", version_mae, "median time:", med_time, "median time when correct:", correct_med_time, "median time when incorrect:", incorrect_med_time)
+            print(s.total, "images classified total:", s.num_correct, "correct, and", s.num_incorrect, "incorrect:", s.score, "absolute error:", s.error, "median time:", s.time_med, "median time when correct:", s.correct_time_med, "median time when incorrect:", s.incorrect_time_med)
 
-        total, num_correct, num_incorrect, score, error, med_time, correct_med_time, incorrect_med_time = calc_classification_stats(all_classifications)
+        s = report.users[username]
         print("overall stats")
-        print(total, "images classified total:", num_correct, "correct, and", num_incorrect, "incorrect:", score, "median time:", med_time, "median time when correct:", correct_med_time, "median time when incorrect:", incorrect_med_time)
+        print(s.total, "images classified total:", s.num_correct, "correct, and", s.num_incorrect, "incorrect:", s.score, "median time:", s.time_med, "median time when correct:", s.correct_time_med, "median time when incorrect:", s.incorrect_time_med)
         print()
 
+    print("-----------------------")
+    print("overall statistics for all (production) users")
+    print("-----------------------")
+    for version, s in report.versions.items():
+        print("stats for version", version, ":")
+        print(s.total, "images classified total:", s.num_correct, "correct, and", s.num_incorrect, "incorrect:", s.score, "MEAN WEIGHTED ABS ERROR:", s.mean_weighted_error, "median time:", s.time_med, "median time when correct:", s.correct_time_med, "median time when incorrect:", s.incorrect_time_med)
+
+    s = report.overall
+    if s:
+        print("overall stats")
+        print(s.total, "images classified total:", s.num_correct, "correct, and", s.num_incorrect, "incorrect:", s.score, "median time:", s.time_med, "median time when correct:", s.correct_time_med, "median time when incorrect:", s.incorrect_time_med)
+        print()
 
+    return report
 
 
 def clear_classifications(username):
@@ -190,8 +284,16 @@ def clear_classifications(username):
             print('User does not exist')
             return
 
+        PairCursor.query.filter_by(user_id=user.id).delete()
+        PairLease.query.filter_by(user_id=user.id).delete()
+        ClassificationSummary.query.filter_by(user_id=user.id).delete()
         Classification.query.filter_by(user=user).delete()
+        user.num_classifications = 0
+        scheduler.recount_ratings()
         db.session.commit()
+        # so every worker reloads the rating counts and the user's history
+        mark_synced()
+        scheduler.balanced_scheduler.reset()
 
 
 if __name__ == '__main__':
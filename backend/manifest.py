@@ -0,0 +1,166 @@
+import hashlib
+import json
+import os
+import threading
+
+from backend.model import PATCH_DIR
+
+# Cached listing of the patch directories, so processes don't have to scan
+# and checksum them on start up. It's rebuilt from the command line, when
+# the patches are synced, and only rescans files whose size or mtime has
+# changed. The app only ever reads it.
+MANIFEST_PATH = os.path.join(PATCH_DIR, 'manifest.json')
+
+DIRECTORIES = {True: 'real', False: 'fake'}
+
+
+def get_id_version(filename):
+    filename = filename.split('.')[0]
+    id_version = filename.split('_')
+    if len(id_version) == 2:
+        patch_id = int(id_version[0])
+        version = int(id_version[1])
+    else:
+        patch_id = int(id_version[0])
+        version = 0
+
+    return patch_id, version
+
+
+def etag(size, mtime_ns):
+    return f'{mtime_ns:x}-{size:x}'
+
+
+def _checksum(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _list_directory(directory):
+    """List the patches in a directory without checksumming them."""
+    files = {}
+    with os.scandir(os.path.join(PATCH_DIR, directory)) as entries:
+        for entry in entries:
+            if not entry.name.endswith('.png') or not entry.is_file():
+                continue
+            stat = entry.stat()
+            file_id, version = get_id_version(entry.name)
+            files[entry.name] = dict(id=file_id, version=version, size=stat.st_size, mtime_ns=stat.st_mtime_ns, sha256=None)
+    return files
+
+
+def _scan_directory(directory, previous):
+    """List the patches in a directory, reusing checksums of files that haven't changed."""
+    files = {}
+    with os.scandir(os.path.join(PATCH_DIR, directory)) as entries:
+        for entry in entries:
+            if not entry.name.endswith('.png') or not entry.is_file():
+                continue
+            stat = entry.stat()
+            old = previous.get(entry.name)
+            if old and old['size'] == stat.st_size and old['mtime_ns'] == stat.st_mtime_ns:
+                files[entry.name] = old
+                continue
+
+            file_id, version = get_id_version(entry.name)
+            files[entry.name] = dict(
+                id=file_id,
+                version=version,
+                size=stat.st_size,
+                mtime_ns=stat.st_mtime_ns,
+                sha256=_checksum(entry.path),
+            )
+    return files
+
+
+class PatchManifest:
+    """Every patch file with its id, version, size, mtime and checksum.
+
+    ``load()`` reads ``manifest.json``, and rescans and rewrites it if
+    either patch directory has changed since it was written. Files
+    overwritten in place don't change their directory's mtime, so
+    ``load(verify=True)`` stats every file to catch those too. That's for
+    the command line: the app just reads whatever was last written.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._manifest = None
+
+    def reset(self):
+        with self._lock:
+            self._manifest = None
+
+    def _dir_mtimes(self):
+        return {
+            directory: os.stat(os.path.join(PATCH_DIR, directory)).st_mtime_ns
+            for directory in DIRECTORIES.values()
+        }
+
+    def _read(self):
+        try:
+            with open(MANIFEST_PATH) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _write(self, manifest):
+        tmp_path = f'{MANIFEST_PATH}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, MANIFEST_PATH)
+
+    def load(self, verify=False):
+        with self._lock:
+            dir_mtimes = self._dir_mtimes()
+            manifest = self._manifest or self._read()
+            if manifest and manifest['dirs'] == dir_mtimes and not verify:
+                self._manifest = manifest
+                return manifest
+
+            previous = manifest['files'] if manifest else {}
+            files = {
+                directory: _scan_directory(directory, previous.get(directory, {}))
+                for directory in DIRECTORIES.values()
+            }
+            new_manifest = dict(dirs=dir_mtimes, files=files)
+            if new_manifest != manifest:
+                self._write(new_manifest)
+            self._manifest = new_manifest
+            return new_manifest
+
+    def _current(self):
+        # what the app uses. Rescanning would checksum every new file in
+        # every worker at once, and the app may not be able to write to the
+        # patch directory, so where the manifest is missing or out of date
+        # the directories are just listed.
+        dir_mtimes = self._dir_mtimes()
+        manifest = self._read()
+        if manifest and manifest['dirs'] == dir_mtimes:
+            return manifest
+        return dict(dirs=dir_mtimes, files={
+            directory: _list_directory(directory)
+            for directory in DIRECTORIES.values()
+        })
+
+    def files(self, real):
+        """Map each filename in the real or fake directory to its entry.
+
+        Uses the manifest from ``load()`` if this process has loaded it.
+        Otherwise it's read without ever being rebuilt, and the entries'
+        checksums are None if the manifest is missing or out of date.
+        """
+        manifest = self._manifest or self._current()
+        return manifest['files'][DIRECTORIES[real]]
+
+    def entries(self):
+        """Yield (relative path, entry) for every patch file."""
+        for real, directory in DIRECTORIES.items():
+            for filename, entry in self.files(real).items():
+                yield os.path.join(directory, filename), entry
+
+
+manifest = PatchManifest()
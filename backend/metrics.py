@@ -0,0 +1,146 @@
+from bisect import bisect_left
+from collections import defaultdict
+import threading
+import time
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Per-process request metrics, exposed in the Prometheus text format at
+# /metrics. Each WSGI worker keeps its own, so scrape every worker (or sum
+# across them) for the full picture.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+class Counter:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._lock = threading.Lock()
+        self._values = defaultdict(float)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] += amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_labels(key)} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        # label key -> (count per bucket plus +Inf, sum)
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * (len(self.buckets) + 1), 0)
+            counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append(f'{self.name}_bucket{_labels(key + (("le", bound),))} {cumulative}')
+                lines.append(f'{self.name}_sum{_labels(key)} {total}')
+                lines.append(f'{self.name}_count{_labels(key)} {cumulative}')
+        return lines
+
+
+request_duration = Histogram(
+    'kidney_request_duration_seconds', 'Time taken to handle a request.', LATENCY_BUCKETS)
+requests_total = Counter(
+    'kidney_requests_total', 'Requests handled, by response status.')
+request_statements = Histogram(
+    'kidney_request_sql_statements', 'SQL statements executed per request.', STATEMENT_BUCKETS)
+request_db_duration = Histogram(
+    'kidney_request_db_seconds', 'Time spent in the database per request.', LATENCY_BUCKETS)
+image_bytes = Counter(
+    'kidney_image_bytes_total', 'Bytes of patch images served.')
+
+METRICS = (request_duration, requests_total, request_statements, request_db_duration, image_bytes)
+
+
+def render():
+    lines = []
+    for metric in METRICS:
+        lines += metric.render()
+    return '\n'.join(lines) + '\n'
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    if has_request_context() and 'sql_statements' in g:
+        g.sql_statements += 1
+        g.db_seconds += elapsed
+
+
+def init_app(app):
+    """Time every request, count its SQL statements and log slow ones.
+
+    Requests slower than the ``SLOW_REQUEST_SECONDS`` config value, if it's
+    set, are logged as warnings with their database usage.
+    """
+
+    @app.before_request
+    def start_request():
+        g.request_start = time.perf_counter()
+        g.sql_statements = 0
+        g.db_seconds = 0.0
+
+    @app.after_request
+    def record_request(response):
+        if 'request_start' not in g:
+            return response
+
+        elapsed = time.perf_counter() - g.request_start
+        endpoint = request.endpoint or 'unmatched'
+        request_duration.observe(elapsed, endpoint=endpoint, method=request.method)
+        requests_total.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+        request_statements.observe(g.sql_statements, endpoint=endpoint)
+        request_db_duration.observe(g.db_seconds, endpoint=endpoint)
+        if response.mimetype.startswith('image/') and response.content_length:
+            image_bytes.inc(response.content_length, mimetype=response.mimetype)
+
+        slow = app.config.get('SLOW_REQUEST_SECONDS')
+        if slow and elapsed > slow:
+            app.logger.warning(
+                'slow request: %s %s took %.3fs, %d SQL statements in %.3fs',
+                request.method, request.full_path, elapsed, g.sql_statements, g.db_seconds,
+            )
+
+        return response
@@ -3,18 +3,27 @@ from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.sql import func
 import os
 
-db = SQLAlchemy(engine_options={"max_overflow": -1})
+db = SQLAlchemy()
 
 
-PATCH_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, 'static', 'patches')
-REAL_PATCHES = os.listdir(os.path.join(PATCH_DIR, 'real'))
-FAKE_PATCHES = os.listdir(os.path.join(PATCH_DIR, 'fake'))
+PATCH_DIR = os.environ.get(
+    'PATCH_DIR',
+    os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, 'static', 'patches'),
+)
 
 
 class Patch(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     real = db.Column(db.Boolean) # True if real, False if fake
     version = db.Column(db.Integer)
+    # number of classifications of pairs with this patch in them, kept up to
+    # date by post_classification for the balanced scheduler
+    num_classifications = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    __table_args__ = (
+        # the pair pools are loaded by version
+        db.Index('ix_patch_version_real', 'version', 'real'),
+    )
 
 
 class Classification(db.Model):
@@ -30,8 +39,64 @@ class Classification(db.Model):
     # correctly classified the real image, and vice versa if false.
     classification = db.Column(db.Boolean) # True if real, False if fake
 
+    __table_args__ = (
+        # one answer per user and pair, so a retried submission can't be
+        # recorded twice
+        db.Index('ix_classification_user_pair', 'user_id', 'real_patch_id', 'fake_patch_id', unique=True),
+        db.Index('ix_classification_real_patch_id', 'real_patch_id'),
+        db.Index('ix_classification_fake_patch_id', 'fake_patch_id'),
+    )
+
 
 class Member(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     username = db.Column(db.String(100), unique=True)
     password = db.Column(db.String(100))
+    # number of unique pairs classified, kept up to date by post_classification
+    num_classifications = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+
+class PairCursor(db.Model):
+    # The real and fake patch up to which each user has classified every
+    # patch in order, so the next pair can be found without scanning their
+    # classifications.
+    user_id = db.Column(db.Integer, db.ForeignKey('member.id'), primary_key=True)
+    real_patch_id = db.Column(db.Integer, db.ForeignKey('patch.id'))
+    fake_patch_id = db.Column(db.Integer, db.ForeignKey('patch.id'))
+
+
+class PairLease(db.Model):
+    # A pair served to a user, which other users aren't given until it's
+    # answered or the lease expires, so raters working at the same time
+    # spread out over the patches instead of all rating the same ones.
+    user_id = db.Column(db.Integer, db.ForeignKey('member.id'), primary_key=True)
+    real_patch_id = db.Column(db.Integer, db.ForeignKey('patch.id'), primary_key=True)
+    fake_patch_id = db.Column(db.Integer, db.ForeignKey('patch.id'), primary_key=True)
+    # the page it was served to, so the user's other tabs get other pairs
+    page = db.Column(db.String(32))
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_pair_lease_expires_at', 'expires_at'),
+    )
+
+
+class ClassificationSummary(db.Model):
+    # Running totals of each user's classifications for each fake patch
+    # version, kept up to date on every submission so results can be read
+    # without scanning the classification table.
+    user_id = db.Column(db.Integer, db.ForeignKey('member.id'), primary_key=True)
+    version = db.Column(db.Integer, primary_key=True) # fake patch version, 0 if unset
+    num_correct = db.Column(db.Integer, nullable=False, default=0)
+    num_incorrect = db.Column(db.Integer, nullable=False, default=0)
+    # the latest classification, to time the next one against
+    last_timestamp = db.Column(db.DateTime)
+    last_correct = db.Column(db.Boolean)
+    # counts and sums of the seconds between consecutive classifications,
+    # labelled by whether the earlier one was correct
+    time_count = db.Column(db.Integer, nullable=False, default=0)
+    time_total = db.Column(db.Float, nullable=False, default=0)
+    correct_time_count = db.Column(db.Integer, nullable=False, default=0)
+    correct_time_total = db.Column(db.Float, nullable=False, default=0)
+    incorrect_time_count = db.Column(db.Integer, nullable=False, default=0)
+    incorrect_time_total = db.Column(db.Float, nullable=False, default=0)
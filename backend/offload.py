@@ -0,0 +1,91 @@
+import base64
+import hashlib
+import os
+import time
+from urllib.parse import quote
+
+from flask import Response, current_app
+
+from backend.derivatives import DERIVED_DIR
+from backend.model import PATCH_DIR
+
+# Hands patch downloads to the web server in front of the app, so a WSGI
+# worker isn't tied up for the length of every image transfer. There are
+# two ways of doing it:
+#
+# PATCH_SENDFILE has the app check the login and resolve the file as usual,
+# then answer with just a header telling the web server which file to send.
+# With Apache that's 'x-sendfile' (mod_xsendfile, with XSendFilePath set to
+# PATCH_DIR). With nginx it's 'x-accel-redirect', and PATCH_DIR needs
+# mapping to PATCH_ACCEL_PREFIX in an internal location:
+#
+#     location /protected-patches/ {
+#         internal;
+#         alias /path/to/static/patches/;
+#     }
+#
+# PATCH_URL_SECRET makes pages link straight to signed URLs that expire,
+# which the web server checks itself, so images don't touch Python at all.
+# Only derived files are linked this way. They're named after the sha256 of
+# their source, so the URL says nothing about whether a patch is real,
+# whereas a source file's path has its class in it. The signature is the
+# one nginx's secure_link module expects:
+#
+#     location /signed-patches/ {
+#         secure_link $arg_md5,$arg_expires;
+#         secure_link_md5 "$secure_link_expires$uri <PATCH_URL_SECRET>";
+#         if ($secure_link = "") { return 403; }
+#         if ($secure_link = "0") { return 410; }
+#         alias /path/to/static/patches/derived/;
+#     }
+
+SENDFILE_HEADERS = {
+    'x-sendfile': 'X-Sendfile',
+    'x-accel-redirect': 'X-Accel-Redirect',
+}
+
+
+def sendfile_response(patch_file):
+    """A response with no body that has the web server send the patch file."""
+    mode = current_app.config['PATCH_SENDFILE']
+    if mode == 'x-sendfile':
+        location = os.path.abspath(patch_file.path)
+    else:
+        relpath = os.path.relpath(patch_file.path, PATCH_DIR).replace(os.sep, '/')
+        location = current_app.config['PATCH_ACCEL_PREFIX'] + quote(relpath)
+
+    response = Response(mimetype=patch_file.mimetype)
+    response.headers[SENDFILE_HEADERS[mode]] = location
+    return response
+
+
+def _signature(uri, expires, secret):
+    digest = hashlib.md5(f'{expires}{uri} {secret}'.encode()).digest()
+    return base64.urlsafe_b64encode(digest).decode().rstrip('=')
+
+
+def can_sign(patch_file):
+    """Whether a patch file can be linked with a signed URL, i.e. it's a derived file."""
+    relpath = os.path.relpath(patch_file.path, DERIVED_DIR)
+    return not patch_file.packed and not relpath.startswith(os.pardir)
+
+
+def signed_url(patch_file, now=None):
+    """A URL for a derived patch file that the web server serves until it expires.
+
+    Expiry times are rounded up to a multiple of ``PATCH_URL_TTL``, so a
+    patch keeps the same URL for a while and browsers can still cache it.
+    Each URL is valid for between one and two TTLs.
+    """
+    if not can_sign(patch_file):
+        raise ValueError(f'{patch_file.path} is not a derived file')
+
+    ttl = current_app.config['PATCH_URL_TTL']
+    now = int(now if now is not None else time.time())
+    expires = (now // ttl + 2) * ttl
+
+    relpath = os.path.relpath(patch_file.path, DERIVED_DIR).replace(os.sep, '/')
+    # signed unquoted, since nginx's $uri is decoded
+    uri = current_app.config['PATCH_URL_PREFIX'] + relpath
+    secret = current_app.config['PATCH_URL_SECRET']
+    return f'{quote(uri)}?md5={_signature(uri, expires, secret)}&expires={expires}'
@@ -0,0 +1,166 @@
+import mmap
+import os
+import struct
+import zlib
+
+import numpy as np
+
+from backend.manifest import DIRECTORIES, manifest
+from backend.model import PATCH_DIR
+
+# Patches packed into one file per directory and version, so serving one is
+# a slice of a shared memory map rather than a path lookup and an open() in
+# a directory of hundreds of thousands of files. Each pack is a header, an
+# index sorted by file id, then the PNGs back to back:
+#
+#     MAGIC | count (u8) | count * INDEX_DTYPE | data
+#
+# Everything's in one file so a rebuilt pack can be swapped in atomically.
+PACK_DIR = os.path.join(PATCH_DIR, 'packs')
+
+MAGIC = b'KIDNEYP1'
+HEADER = struct.Struct('<8sQ')
+INDEX_DTYPE = np.dtype([
+    ('id', '<i8'),
+    ('offset', '<u8'),
+    ('length', '<u4'),
+    ('crc32', '<u4'),
+    # of the loose file, so a packed patch keeps the same etag
+    ('mtime_ns', '<i8'),
+])
+
+
+def pack_path(real, version):
+    return os.path.join(PACK_DIR, f'{DIRECTORIES[real]}_{version}.pack')
+
+
+class Pack:
+    """A pack file mapped read only, with its index as an array over the mapping."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count = HEADER.unpack_from(self.data)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a patch pack')
+        self.index = np.frombuffer(self.data, dtype=INDEX_DTYPE, count=count, offset=HEADER.size)
+
+    def find(self, file_id):
+        """Return the index entry for a file id, or None if it isn't in the pack."""
+        ids = self.index['id']
+        i = np.searchsorted(ids, file_id)
+        if i < len(ids) and ids[i] == file_id:
+            return self.index[i]
+        return None
+
+    def view(self, entry):
+        offset = int(entry['offset'])
+        return memoryview(self.data)[offset:offset + int(entry['length'])]
+
+
+def load_packs():
+    """Map every pack in ``PACK_DIR``, keyed by (real, version)."""
+    packs = {}
+    try:
+        names = os.listdir(PACK_DIR)
+    except FileNotFoundError:
+        return packs
+
+    for real, directory in DIRECTORIES.items():
+        for name in names:
+            stem, ext = os.path.splitext(name)
+            prefix, _, version = stem.rpartition('_')
+            if ext == '.pack' and prefix == directory and version.isdigit():
+                packs[real, int(version)] = Pack(os.path.join(PACK_DIR, name))
+    return packs
+
+
+def _write_pack(path, directory, entries):
+    """Write the loose files for ``entries``, a list of (filename, manifest entry), into a pack."""
+    entries = sorted(entries, key=lambda item: item[1]['id'])
+    index = np.zeros(len(entries), dtype=INDEX_DTYPE)
+    offset = HEADER.size + index.nbytes
+
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.seek(offset)
+        for i, (filename, entry) in enumerate(entries):
+            with open(os.path.join(PATCH_DIR, directory, filename), 'rb') as patch:
+                data = patch.read()
+            f.write(data)
+            index[i] = (entry['id'], offset, len(data), zlib.crc32(data), entry['mtime_ns'])
+            offset += len(data)
+
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, len(entries)))
+        f.write(index.tobytes())
+    os.replace(tmp_path, path)
+
+
+def build():
+    """Pack every loose patch, one pack per directory and version.
+
+    Packs whose contents would be unchanged are left alone. Returns the
+    number of patches in each pack, keyed by pack path.
+    """
+    manifest.load(verify=True)
+    os.makedirs(PACK_DIR, exist_ok=True)
+    existing = load_packs()
+
+    groups = {}
+    for real, directory in DIRECTORIES.items():
+        for filename, entry in manifest.files(real).items():
+            groups.setdefault((real, entry['version']), []).append((filename, entry))
+
+    built = {}
+    for (real, version), entries in sorted(groups.items()):
+        path = pack_path(real, version)
+        pack = existing.get((real, version))
+        if pack is not None and _up_to_date(pack, entries):
+            built[path] = len(entries)
+            continue
+        _write_pack(path, DIRECTORIES[real], entries)
+        built[path] = len(entries)
+    return built
+
+
+def _up_to_date(pack, entries):
+    if len(pack.index) != len(entries):
+        return False
+    for _, entry in entries:
+        packed = pack.find(entry['id'])
+        if packed is None or packed['length'] != entry['size'] or packed['mtime_ns'] != entry['mtime_ns']:
+            return False
+    return True
+
+
+def verify():
+    """Check every pack against its checksums and the loose files, returning a list of problems."""
+    problems = []
+    manifest.load(verify=True)
+    for (real, version), pack in sorted(load_packs().items()):
+        ids = pack.index['id']
+        if np.any(ids[1:] <= ids[:-1]):
+            problems.append(f'{pack.path}: index is not sorted by id')
+
+        end = pack.index['offset'].astype(np.int64) + pack.index['length']
+        if len(end) and end.max() > len(pack.data):
+            problems.append(f'{pack.path}: index points past the end of the pack')
+            continue
+
+        for entry in pack.index:
+            if zlib.crc32(pack.view(entry)) != entry['crc32']:
+                problems.append(f"{pack.path}: patch {entry['id']} doesn't match its checksum")
+
+        # loose files changed or added since the pack was built, which are
+        # served in place of the pack until it's rebuilt
+        for filename, entry in manifest.files(real).items():
+            if entry['version'] != version:
+                continue
+            packed = pack.find(entry['id'])
+            if packed is None:
+                problems.append(f'{pack.path}: {filename} is not packed')
+            elif packed['length'] != entry['size'] or packed['mtime_ns'] != entry['mtime_ns']:
+                problems.append(f'{pack.path}: {filename} has changed since it was packed')
+    return problems
@@ -0,0 +1,192 @@
+from bisect import bisect_right
+import os
+import threading
+
+from sqlalchemy.sql.expression import func
+
+from backend.experiments import active_versions
+from backend.model import db, Classification, Patch, PairCursor, PATCH_DIR
+
+# touched once the patch table has been synced with the patch directories,
+# or classifications have been deleted, so workers know to reload anything
+# they've built from them
+SYNCED_PATH = os.path.join(PATCH_DIR, 'synced')
+
+# how many of a user's upcoming patches are checked against their answers
+# in one query. The window doubles while the user has answered everything in
+# it, up to MAX_WINDOW, so long runs of answers are skipped in a few queries.
+WINDOW = 50
+MAX_WINDOW = 2000
+
+
+def synced_at():
+    try:
+        return os.stat(SYNCED_PATH).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def mark_synced():
+    with open(SYNCED_PATH, 'a'):
+        pass
+    os.utime(SYNCED_PATH)
+
+
+def servable_patches():
+    """Query the (id, real, version) of every patch in an active version, in id order.
+
+    Covered by the (version, real) index, so the cost depends on the active
+    versions rather than how many versions are stored.
+    """
+    return (
+        db.session.query(Patch.id, Patch.real, Patch.version)
+        .filter(Patch.version.in_(list(active_versions())))
+        .order_by(Patch.id)
+    )
+
+
+class PairQueue:
+    """Hands out each user's next (real, fake) pair from in-memory id pools.
+
+    The pools are the sorted ids of the patches in every active version.
+    They're built on first use and reloaded whenever the patches are synced
+    again. Versions are served in id order
+    here, so their weights only apply with the balanced scheduler.
+
+    Each user's cursor in the ``pair_cursor`` table marks how far they've
+    answered every patch in order. Patches past it are checked against the
+    user's answers a window at a time, so pairs answered out of order, such
+    as prefetched ones, are skipped without skipping the ones before them.
+    Syncing patches rewinds the cursors past any new ones, and so does
+    activating a version whose ids are lower than the cursors, through
+    ``rewind()``.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pools = None
+        self._synced_at = None
+
+    def reset(self):
+        with self._lock:
+            self._pools = None
+
+    def _load(self):
+        pools = {True: [], False: []}
+        for patch_id, real, _ in servable_patches():
+            pools[bool(real)].append(patch_id)
+        return pools
+
+    def pools(self):
+        synced = synced_at()
+        if self._pools is None or synced != self._synced_at:
+            with self._lock:
+                if self._pools is None or synced != self._synced_at:
+                    self._pools = self._load()
+                    self._synced_at = synced
+        return self._pools
+
+    def _answered(self, user_id, real, patch_ids):
+        # covered by the classification indexes
+        column = Classification.real_patch_id if real else Classification.fake_patch_id
+        return set(
+            patch_id for (patch_id,) in
+            db.session.query(column)
+            .filter(column.in_(patch_ids))
+            .filter(Classification.user_id == user_id)
+        )
+
+    def _windows(self, user_id, real, after):
+        """Yield the pool ids after ``after`` a window at a time, with the ones the user has answered."""
+        ids = self.pools()[real]
+        i = 0 if after is None else bisect_right(ids, after)
+        size = WINDOW
+        while i < len(ids):
+            window = ids[i:i + size]
+            answered = self._answered(user_id, real, window)
+            yield window, answered
+            i += size
+            if len(answered) == len(window):
+                size = min(size * 2, MAX_WINDOW)
+
+    def _upcoming(self, user_id, real, after, count, exclude=()):
+        upcoming = []
+        for window, answered in self._windows(user_id, real, after):
+            upcoming.extend(patch_id for patch_id in window if patch_id not in answered and patch_id not in exclude)
+            if len(upcoming) >= count:
+                break
+        return upcoming[:count]
+
+    def _catch_up(self, user_id, real, after):
+        """Return the last id of the run of answered patches after ``after``."""
+        for window, answered in self._windows(user_id, real, after):
+            for patch_id in window:
+                if patch_id not in answered:
+                    return after
+                after = patch_id
+        return after
+
+    def cursor(self, user, commit=True):
+        cursor = db.session.get(PairCursor, user.id)
+        if cursor:
+            return cursor
+
+        # first visit since the cursor table was added, so pick up from
+        # wherever the user's existing classifications got to
+        cursor = PairCursor(
+            user_id=user.id,
+            real_patch_id=self._catch_up(user.id, True, None),
+            fake_patch_id=self._catch_up(user.id, False, None),
+        )
+        db.session.add(cursor)
+        if commit:
+            db.session.commit()
+        return cursor
+
+    def next_pairs(self, user, count, exclude=((), ())):
+        """Return up to ``count`` of the user's upcoming (real, fake) pairs, in order.
+
+        ``exclude`` is a pair of sets of real and fake patch ids to skip as
+        well. They're only skipped for now, since the cursor never moves
+        past a patch the user hasn't answered.
+        """
+        cursor = self.cursor(user)
+        return list(zip(
+            self._upcoming(user.id, True, cursor.real_patch_id, count, exclude[0]),
+            self._upcoming(user.id, False, cursor.fake_patch_id, count, exclude[1]),
+        ))
+
+    def next_pair(self, user):
+        pairs = self.next_pairs(user, 1)
+        return pairs[0] if pairs else (None, None)
+
+    def advance(self, user):
+        # move past the patches answered in order, once the answers are
+        # written. The caller commits, so this lands in the same
+        # transaction as the classifications themselves.
+        cursor = self.cursor(user, commit=False)
+        cursor.real_patch_id = self._catch_up(user.id, True, cursor.real_patch_id)
+        cursor.fake_patch_id = self._catch_up(user.id, False, cursor.fake_patch_id)
+
+    def rewind(self, real_patch_id=None, fake_patch_id=None):
+        """Move every cursor back before the given real and fake patch ids, so they're served.
+
+        For patches that have become servable, which may have lower ids
+        than where users have got to. The caller commits.
+        """
+        for real, patch_id, column in (
+            (True, real_patch_id, PairCursor.real_patch_id),
+            (False, fake_patch_id, PairCursor.fake_patch_id),
+        ):
+            if patch_id is None:
+                continue
+            # the last patch before it, which every cursor past it has answered
+            before = (
+                db.session.query(func.max(Patch.id))
+                .filter(Patch.id < patch_id, Patch.real == real)
+                .scalar()
+            )
+            PairCursor.query.filter(column >= patch_id).update({column: before}, synchronize_session=False)
+
+
+pair_queue = PairQueue()
@@ -0,0 +1,244 @@
+from collections import OrderedDict
+from datetime import datetime, timezone
+import os
+import threading
+
+from flask import current_app
+
+from backend import derivatives
+from backend.manifest import etag, manifest
+from backend.model import db, Patch, PATCH_DIR
+from backend.packs import PACK_DIR, load_packs
+from backend.pair_queue import servable_patches, synced_at
+
+
+def patch_file_id(patch_id, real):
+    # patch ids interleave the two directories: real patches have even ids
+    # and fake patches have odd ids
+    return patch_id // 2 if real else (patch_id - 1) // 2
+
+
+def resolve_patch_path(patch_id, real, version, filenames=None):
+    """Return the file for a patch, preferring a ``{id}_{version}.png`` override.
+
+    ``filenames`` is an optional collection of the names in the patch's
+    directory, to save a stat per patch when resolving many at once.
+    """
+    directory = os.path.join(PATCH_DIR, 'real' if real else 'fake')
+    file_id = patch_file_id(patch_id, real)
+    versioned = f'{file_id}_{version}.png'
+    if filenames is not None:
+        exists = versioned in filenames
+    else:
+        exists = os.path.exists(os.path.join(directory, versioned))
+
+    return os.path.join(directory, versioned if exists else f'{file_id}.png')
+
+
+def find_packed(packs, real, file_id, versions):
+    """Return the first (pack, index entry, version) holding a file, trying each version in turn."""
+    for version in versions:
+        pack = packs.get((real, version))
+        entry = pack.find(file_id) if pack else None
+        if entry is not None:
+            return pack, entry, version
+    return None
+
+
+class PatchFile:
+    __slots__ = ('path', 'mimetype', 'size', 'etag', 'last_modified', 'packed')
+
+    def __init__(self, path, mimetype='image/png', size=None, mtime_ns=None, packed=None):
+        # size and mtime come from the manifest where we have it, to save a stat
+        if size is None or mtime_ns is None:
+            stat = os.stat(path)
+            size, mtime_ns = stat.st_size, stat.st_mtime_ns
+        self.path = path
+        self.mimetype = mimetype
+        self.size = size
+        self.etag = etag(size, mtime_ns)
+        self.last_modified = datetime.fromtimestamp(mtime_ns // 10**9, timezone.utc)
+        # (pack, index entry) if the file is served from a pack
+        self.packed = packed
+
+
+class PatchStore:
+    """Resolves patch ids to files and keeps recently served bytes in memory.
+
+    The id -> file index is built from the patch table and the patch
+    manifest, so serving a patch doesn't need a database query or a stat.
+    It's built again whenever the patches are synced or the packs are
+    rebuilt, by any process. File contents are kept in an LRU cache bounded
+    by the ``PATCH_CACHE_BYTES`` config value.
+
+    Derived encodings of each patch (see ``backend.derivatives``) are served
+    from the same cache when they're available and up to date. Their index
+    is read again whenever it's rewritten.
+
+    Patches in a pack (see ``backend.packs``) are read straight from its
+    memory map instead, which every worker shares, unless the loose file has
+    changed since it was packed.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._index = None
+        self._index_version = None
+        self._derived_index = None
+        self._derived_mtime = None
+        self._derived_files = {}
+        self._cache = OrderedDict()
+        self._cache_bytes = 0
+
+    def reset(self):
+        with self._lock:
+            self._index = None
+            self._index_version = None
+            self._derived_index = None
+            self._derived_mtime = None
+            self._derived_files.clear()
+            self._cache.clear()
+            self._cache_bytes = 0
+
+    def _load(self):
+        files = {real: manifest.files(real) for real in (True, False)}
+        packs = load_packs()
+        index = {}
+        # only the patches being served, so the index doesn't grow with old
+        # versions. Any others are looked up when they're asked for.
+        for patch_id, real, version in servable_patches():
+            real = bool(real)
+            path = resolve_patch_path(patch_id, real, version, files[real])
+            entry = files[real].get(os.path.basename(path))
+
+            # the pack holding the same file as the loose one, or where there
+            # isn't a loose one, the pack it would have come from
+            file_id = patch_file_id(patch_id, real)
+            packed = find_packed(packs, real, file_id, (entry['version'],) if entry else (version, 0))
+            if packed:
+                pack, packed_entry, packed_version = packed
+                size, mtime_ns = int(packed_entry['length']), int(packed_entry['mtime_ns'])
+                if not entry:
+                    filename = f'{file_id}_{packed_version}.png' if packed_version else f'{file_id}.png'
+                    path = os.path.join(os.path.dirname(path), filename)
+                if not entry or (entry['size'], entry['mtime_ns']) == (size, mtime_ns):
+                    index[patch_id] = PatchFile(path, size=size, mtime_ns=mtime_ns, packed=(pack, packed_entry))
+                    continue
+
+            if entry:
+                index[patch_id] = PatchFile(path, size=entry['size'], mtime_ns=entry['mtime_ns'])
+        return index
+
+    def _version(self):
+        # building packs replaces the files in PACK_DIR, which changes its mtime
+        try:
+            packs_mtime = os.stat(PACK_DIR).st_mtime_ns
+        except FileNotFoundError:
+            packs_mtime = None
+        return synced_at(), packs_mtime
+
+    def index(self):
+        version = self._version()
+        if self._index is None or version != self._index_version:
+            with self._lock:
+                if self._index is None or version != self._index_version:
+                    self._index = self._load()
+                    self._index_version = version
+        return self._index
+
+    def get(self, patch_id):
+        """Return the ``PatchFile`` for a patch id, or None if there isn't one."""
+        index = self.index()
+        patch_file = index.get(patch_id)
+        if patch_file:
+            return patch_file
+
+        # patches added since the index was built
+        patch = db.session.get(Patch, patch_id)
+        if not patch:
+            return None
+        try:
+            patch_file = PatchFile(resolve_patch_path(patch.id, patch.real, patch.version))
+        except FileNotFoundError:
+            return None
+        index[patch_id] = patch_file
+        return patch_file
+
+    def derived(self, patch_file):
+        """Return the derived index entry for a patch file, or None if it's missing or stale."""
+        # reloaded whenever build_derivatives() writes a new index, from any process
+        try:
+            mtime = os.stat(derivatives.DERIVED_INDEX).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if self._derived_index is None or mtime != self._derived_mtime:
+            with self._lock:
+                if self._derived_index is None or mtime != self._derived_mtime:
+                    self._derived_index = derivatives.load_index()
+                    self._derived_mtime = mtime
+
+        entry = self._derived_index.get(os.path.relpath(patch_file.path, PATCH_DIR))
+        if not entry or entry['etag'] != patch_file.etag:
+            return None
+        return entry
+
+    def variants(self, patch_file):
+        entry = self.derived(patch_file)
+        return entry['variants'] if entry else []
+
+    def variant(self, patch_file, fmt, width=None):
+        """Return the ``PatchFile`` for an encoding of a patch, falling back to the source."""
+        entry = self.derived(patch_file)
+        if not entry:
+            return patch_file
+
+        width = width or entry['width']
+        if fmt == 'png' and width == entry['width']:
+            return patch_file
+        if [fmt, width] not in entry['variants']:
+            return patch_file
+
+        path = derivatives.derived_path(entry['sha256'], width, fmt)
+        variant_file = self._derived_files.get(path)
+        if not variant_file:
+            try:
+                variant_file = PatchFile(path, derivatives.MIMETYPES[fmt])
+            except FileNotFoundError:
+                return patch_file
+            self._derived_files[path] = variant_file
+        return variant_file
+
+    def read(self, patch_file):
+        """Return a patch file's bytes.
+
+        Raises FileNotFoundError if a loose file has gone, such as once it's
+        been packed and deleted by another process.
+        """
+        if patch_file.packed:
+            # the page cache is shared between workers, so there's no need
+            # to keep a copy of our own
+            pack, entry = patch_file.packed
+            return bytes(pack.view(entry))
+
+        with self._lock:
+            data = self._cache.get(patch_file.path)
+            if data is not None:
+                self._cache.move_to_end(patch_file.path)
+                return data
+
+        with open(patch_file.path, 'rb') as f:
+            data = f.read()
+
+        max_bytes = current_app.config['PATCH_CACHE_BYTES']
+        if len(data) <= max_bytes:
+            with self._lock:
+                if patch_file.path not in self._cache:
+                    self._cache[patch_file.path] = data
+                    self._cache_bytes += len(data)
+                while self._cache_bytes > max_bytes:
+                    _, evicted = self._cache.popitem(last=False)
+                    self._cache_bytes -= len(evicted)
+        return data
+
+
+patch_store = PatchStore()
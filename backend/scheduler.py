@@ -0,0 +1,442 @@
+from collections import defaultdict, OrderedDict
+import heapq
+import math
+import random
+import threading
+
+from sqlalchemy import func, select
+
+from backend.experiments import active_versions
+from backend.model import db, Classification, Patch
+from backend.pair_queue import synced_at
+
+# Serving patches in id order means every rater starts on the same few
+# patches, so most ratings pile up on a handful of them. The balanced
+# scheduler instead always serves the least rated patches the user hasn't
+# seen, which spreads ratings evenly and gets a per-version score we can
+# trust from far fewer ratings (see ``simulate``).
+
+# most users whose pools each worker keeps, dropping the least recently
+# served first. Each holds an entry for every patch the user hasn't rated.
+MAX_USERS = 100
+
+
+class RatingCounts:
+    """The rating count of each patch, and the total for each version.
+
+    Versions are weighted by ``weights``, 1 by default, for picking which
+    version to serve next.
+    """
+
+    def __init__(self, versions, counts=None, weights=None):
+        # versions maps patch id -> version
+        counts = counts or {}
+        self.versions = dict(versions)
+        self.weights = weights or {}
+        self.counts = {patch_id: counts.get(patch_id, 0) for patch_id in self.versions}
+        self.version_counts = defaultdict(int)
+        for patch_id, version in self.versions.items():
+            self.version_counts[version] += self.counts[patch_id]
+
+    def __contains__(self, patch_id):
+        return patch_id in self.versions
+
+    def _set(self, patch_id, count):
+        version = self.versions[patch_id]
+        self.version_counts[version] += count - self.counts[patch_id]
+        self.counts[patch_id] = count
+
+    def record(self, patch_id):
+        if patch_id in self.versions:
+            self._set(patch_id, self.counts[patch_id] + 1)
+
+    def update(self, patch_id, count):
+        """Raise a patch's rating count to ``count``, if it's behind. Returns whether it was."""
+        if patch_id not in self.versions or count <= self.counts[patch_id]:
+            return False
+        self._set(patch_id, count)
+        return True
+
+
+class BalancedPool(RatingCounts):
+    """Patches grouped by version, each group a min-heap on rating count.
+
+    Picking the least rated patch is a heap pop, and recording a rating
+    pushes a fresh entry rather than re-sorting, so both are O(log n). Old
+    entries are skipped when they reach the top. Versions are picked by
+    lowest ratings per unit of weight, so each gets its share of traffic
+    regardless of how many patches it has.
+    """
+
+    def __init__(self, versions, counts=None, weights=None):
+        super().__init__(versions, counts, weights)
+        self.heaps = defaultdict(list)
+        for patch_id, version in self.versions.items():
+            # random tie-break, so raters arriving together don't all get
+            # the same patch
+            self.heaps[version].append((self.counts[patch_id], random.random(), patch_id))
+        for heap in self.heaps.values():
+            heapq.heapify(heap)
+
+    def _set(self, patch_id, count):
+        super()._set(patch_id, count)
+        heapq.heappush(self.heaps[self.versions[patch_id]], (count, random.random(), patch_id))
+
+    def _pop_unseen(self, version, exclude):
+        heap = self.heaps[version]
+        skipped = []
+        found = None
+        while heap:
+            entry = heapq.heappop(heap)
+            count, _, patch_id = entry
+            if count != self.counts[patch_id]:
+                # superseded by a later rating
+                continue
+            skipped.append(entry)
+            if not any(patch_id in ids for ids in exclude):
+                found = patch_id
+                break
+        for entry in skipped:
+            heapq.heappush(heap, entry)
+        return found
+
+    def select(self, count, *exclude):
+        """Return up to ``count`` of the least rated patches not in any of the ``exclude`` sets.
+
+        Nothing is recorded, so asking again before any ratings come in gives
+        the same patches.
+        """
+        selected_ids = set()
+        exclude += (selected_ids,)
+        planned = defaultdict(int)
+        exhausted = set()
+        selected = []
+        while len(selected) < count:
+            candidates = [version for version in self.heaps if version not in exhausted]
+            if not candidates:
+                break
+            version = min(
+                candidates,
+                key=lambda v: ((self.version_counts[v] + planned[v]) / self.weights.get(v, 1), v),
+            )
+            patch_id = self._pop_unseen(version, exclude)
+            if patch_id is None:
+                exhausted.add(version)
+                continue
+            selected_ids.add(patch_id)
+            planned[version] += 1
+            selected.append(patch_id)
+        return selected
+
+
+class UserPool(BalancedPool):
+    """One user's heaps of the patches they haven't rated, over shared ``RatingCounts``.
+
+    Entries for patches rated since the heaps were built are pushed back
+    with their new count when they reach the top, and patches the user has
+    rated are dropped for good. So however much the user has rated, each
+    selection is O(log n) amortised, rather than walking past everything
+    they've already seen.
+    """
+
+    def __init__(self, ratings, seen):
+        # rated patches are added to ``seen`` as they come in, and dropped
+        # from the heaps lazily
+        self.seen = seen
+        self.versions = ratings.versions
+        self.weights = ratings.weights
+        self.counts = ratings.counts
+        self.version_counts = ratings.version_counts
+        self.heaps = defaultdict(list)
+        for patch_id, version in ratings.versions.items():
+            if patch_id not in seen:
+                self.heaps[version].append((self.counts[patch_id], random.random(), patch_id))
+        for heap in self.heaps.values():
+            heapq.heapify(heap)
+
+    def _pop_unseen(self, version, exclude):
+        heap = self.heaps[version]
+        skipped = []
+        found = None
+        while heap:
+            count, _, patch_id = heap[0]
+            if patch_id in self.seen:
+                heapq.heappop(heap)
+                continue
+            if count != self.counts[patch_id]:
+                # rated by someone else since, so it moves down the heap
+                heapq.heapreplace(heap, (self.counts[patch_id], random.random(), patch_id))
+                continue
+            skipped.append(heapq.heappop(heap))
+            if not any(patch_id in ids for ids in exclude):
+                found = patch_id
+                break
+        # nothing is recorded until it's rated, so the selected and excluded
+        # patches go back
+        for entry in skipped:
+            heapq.heappush(heap, entry)
+        return found
+
+
+class BalancedScheduler:
+    """Hands out each user's next pairs from the least rated patches.
+
+    The pools are built from the patch table's rating counts on first use,
+    and rebuilt whenever the patches are synced again. They're kept up to
+    date as this worker saves classifications, and the counts of the
+    chosen patches are read back from the database, to pick up ratings
+    saved through other workers before they're served.
+
+    Each user's classified patches are loaded once, into a ``UserPool`` of
+    the patches they haven't rated, and kept for the ``MAX_USERS`` most
+    recently served users. The chosen patches are double checked against
+    the database in case they were classified through another worker.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pools = None
+        self._synced_at = None
+        self._users = OrderedDict()
+
+    def reset(self):
+        with self._lock:
+            self._pools = None
+            self._users.clear()
+
+    def _load(self):
+        versions = {True: {}, False: {}}
+        counts = {}
+        rows = (
+            db.session.query(Patch.id, Patch.real, Patch.version, Patch.num_classifications)
+            .filter(Patch.version.in_(list(active_versions())))
+        )
+        for patch_id, real, version, num_classifications in rows:
+            versions[bool(real)][patch_id] = version
+            counts[patch_id] = num_classifications
+
+        return {
+            # real patches all come from the same slides, so they're balanced
+            # as one group
+            True: RatingCounts({patch_id: None for patch_id in versions[True]}, counts),
+            False: RatingCounts(versions[False], counts, active_versions()),
+        }
+
+    def pools(self):
+        # syncing patches, or clearing a user's classifications, is rare
+        # enough that everything is reloaded, histories included
+        synced = synced_at()
+        if self._pools is None or synced != self._synced_at:
+            with self._lock:
+                if self._pools is None or synced != self._synced_at:
+                    self._pools = self._load()
+                    self._synced_at = synced
+                    self._users.clear()
+        return self._pools
+
+    def _user_pools(self, user_id, pools):
+        with self._lock:
+            user_pools = self._users.get(user_id)
+            if user_pools is not None:
+                self._users.move_to_end(user_id)
+                return user_pools
+
+        seen = {True: set(), False: set()}
+        rows = (
+            db.session.query(Classification.real_patch_id, Classification.fake_patch_id)
+            .filter_by(user_id=user_id)
+        )
+        for real_patch_id, fake_patch_id in rows:
+            seen[True].add(real_patch_id)
+            seen[False].add(fake_patch_id)
+        # built outside the lock, since it reads every patch. Counts that
+        # change meanwhile are caught up as their entries reach the top.
+        user_pools = {real: UserPool(pools[real], seen[real]) for real in (True, False)}
+
+        with self._lock:
+            self._users[user_id] = user_pools
+            while len(self._users) > MAX_USERS:
+                self._users.popitem(last=False)
+        return user_pools
+
+    def _classified(self, user_id, real_patch_ids, fake_patch_ids):
+        # both lookups are covered by the classification indexes
+        real = set(
+            patch_id for (patch_id,) in
+            db.session.query(Classification.real_patch_id)
+            .filter(Classification.user_id == user_id)
+            .filter(Classification.real_patch_id.in_(real_patch_ids))
+        )
+        fake = set(
+            patch_id for (patch_id,) in
+            db.session.query(Classification.fake_patch_id)
+            .filter(Classification.fake_patch_id.in_(fake_patch_ids))
+            .filter(Classification.user_id == user_id)
+        )
+        return real, fake
+
+    def _catch_up(self, pools, real_patch_ids, fake_patch_ids):
+        """Raise the chosen patches' counts to the database's. Returns whether any were behind."""
+        counts = db.session.execute(
+            select(Patch.id, Patch.num_classifications)
+            .where(Patch.id.in_(real_patch_ids + fake_patch_ids))
+        )
+        behind = False
+        with self._lock:
+            for patch_id, num_classifications in counts:
+                pool = pools[True] if patch_id in pools[True] else pools[False]
+                behind |= pool.update(patch_id, num_classifications)
+        return behind
+
+    def next_pairs(self, user, count, exclude=((), ())):
+        """Return up to ``count`` (real, fake) pairs of patches the user hasn't classified.
+
+        ``exclude`` is a pair of sets of real and fake patch ids to skip as well.
+        """
+        pools = self.pools()
+        user_pools = self._user_pools(user.id, pools)
+        while True:
+            with self._lock:
+                real_patch_ids = user_pools[True].select(count, exclude[0])
+                fake_patch_ids = user_pools[False].select(count, exclude[1])
+            if not real_patch_ids or not fake_patch_ids:
+                return []
+
+            if self._catch_up(pools, real_patch_ids, fake_patch_ids):
+                # rated through other workers, so they may not be the least
+                # rated any more
+                continue
+
+            real, fake = self._classified(user.id, real_patch_ids, fake_patch_ids)
+            if not real and not fake:
+                return list(zip(real_patch_ids, fake_patch_ids))
+
+            # classified through another worker since we loaded them
+            with self._lock:
+                user_pools[True].seen |= real
+                user_pools[False].seen |= fake
+
+    def next_pair(self, user):
+        pairs = self.next_pairs(user, 1)
+        return pairs[0] if pairs else (None, None)
+
+    def record(self, user, pairs):
+        """Count a user's newly saved (real, fake) pairs towards each patch."""
+        pools = self.pools()
+        with self._lock:
+            user_pools = self._users.get(user.id)
+            for real_patch_id, fake_patch_id in pairs:
+                pools[True].record(real_patch_id)
+                pools[False].record(fake_patch_id)
+                if user_pools:
+                    user_pools[True].seen.add(real_patch_id)
+                    user_pools[False].seen.add(fake_patch_id)
+
+
+balanced_scheduler = BalancedScheduler()
+
+
+def count_ratings(pairs):
+    """Add newly saved (real, fake) pairs to their patches' rating counts. The caller commits."""
+    counts = defaultdict(int)
+    for real_patch_id, fake_patch_id in pairs:
+        counts[real_patch_id] += 1
+        counts[fake_patch_id] += 1
+
+    # one update for each distinct increment, which is nearly always just one
+    by_increment = defaultdict(list)
+    for patch_id, increment in counts.items():
+        by_increment[increment].append(patch_id)
+    for increment, patch_ids in by_increment.items():
+        (
+            Patch.query.filter(Patch.id.in_(patch_ids))
+            .update({Patch.num_classifications: Patch.num_classifications + increment}, synchronize_session=False)
+        )
+
+
+def recount_ratings():
+    """Count every patch's ratings again, after classifications have been deleted. The caller commits."""
+    real = select(func.count()).where(Classification.real_patch_id == Patch.id).scalar_subquery()
+    fake = select(func.count()).where(Classification.fake_patch_id == Patch.id).scalar_subquery()
+    Patch.query.update({Patch.num_classifications: real + fake}, synchronize_session=False)
+
+
+class SequentialPool:
+    """Serves each rater the lowest id they haven't seen, like ``PairQueue``."""
+
+    def __init__(self, versions):
+        self.ids = sorted(versions)
+
+    def record(self, patch_id):
+        pass
+
+    def select(self, count, *exclude):
+        return [patch_id for patch_id in self.ids if not any(patch_id in ids for ids in exclude)][:count]
+
+
+SIMULATED_POOLS = {
+    'sequential': SequentialPool,
+    'balanced': BalancedPool,
+}
+
+
+def ci_half_width(patch_ids, fooled):
+    """95% confidence interval half width of the fraction of raters fooled.
+
+    Ratings of the same patch aren't independent, so the standard error is
+    clustered on the patch: the interval only narrows as more distinct
+    patches are rated, not just more ratings.
+    """
+    n = len(fooled)
+    clusters = defaultdict(lambda: [0, 0])
+    for patch_id, f in zip(patch_ids, fooled):
+        clusters[patch_id][0] += 1
+        clusters[patch_id][1] += f
+    if len(clusters) < 2:
+        return math.inf
+
+    score = sum(fooled) / n
+    variance = sum((k - m * score) ** 2 for m, k in clusters.values()) / n ** 2
+    variance *= len(clusters) / (len(clusters) - 1)
+    return 1.96 * math.sqrt(variance)
+
+
+def simulate(strategy, num_patches=1000, versions=(1,), num_raters=20, target=0.05,
+             max_ratings=100000, check_every=50, seed=0):
+    """Count the ratings needed until every version's score is known to within ``target``.
+
+    Each simulated fake patch has its own chance of fooling a rater, drawn
+    around a per-version mean, and raters rate one pair at a time in a
+    random order, each picked by ``strategy`` ('sequential' or 'balanced').
+    Returns the number of ratings, or None if ``max_ratings`` wasn't enough.
+    """
+    rng = random.Random(seed)
+    patch_versions = {patch_id: versions[patch_id % len(versions)] for patch_id in range(num_patches)}
+    version_means = {version: rng.uniform(0.2, 0.45) for version in versions}
+    fool_chance = {
+        patch_id: rng.betavariate(version_means[version] * 4, (1 - version_means[version]) * 4)
+        for patch_id, version in patch_versions.items()
+    }
+
+    pool = SIMULATED_POOLS[strategy](patch_versions)
+    seen = [set() for _ in range(num_raters)]
+    rated = defaultdict(lambda: ([], []))
+
+    for n in range(1, max_ratings + 1):
+        rater = rng.randrange(num_raters)
+        selected = pool.select(1, seen[rater])
+        if not selected:
+            return None
+        patch_id = selected[0]
+        seen[rater].add(patch_id)
+        pool.record(patch_id)
+        patch_ids, fooled = rated[patch_versions[patch_id]]
+        patch_ids.append(patch_id)
+        fooled.append(rng.random() < fool_chance[patch_id])
+
+        if n % check_every == 0 and len(rated) == len(versions) and all(
+            ci_half_width(patch_ids, fooled) <= target for patch_ids, fooled in rated.values()
+        ):
+            return n
+
+    return None
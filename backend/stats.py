@@ -0,0 +1,219 @@
+import csv
+from dataclasses import asdict, dataclass
+import io
+import json
+
+import numpy as np
+
+from backend.model import db, Classification, Member, Patch
+
+# assume nobody will take longer than 5 mins per image
+MAX_TIME = 5 * 60
+
+
+@dataclass
+class Stats:
+    total: int
+    num_correct: int
+    num_incorrect: int
+    # fraction of pairs where the fake patch was picked as real
+    score: float
+    # distance of the score from chance
+    error: float
+    time_med: float
+    correct_time_med: float
+    incorrect_time_med: float
+    # mean of each user's error weighted by how many they classified, only
+    # set for versions across all production users
+    mean_weighted_error: float = None
+
+
+@dataclass
+class Report:
+    # username -> version -> stats, plus username -> overall stats
+    user_versions: dict
+    users: dict
+    # version -> stats and overall stats across production users
+    versions: dict
+    overall: Stats
+
+    def rows(self):
+        for username, versions in self.user_versions.items():
+            for version, stats in versions.items():
+                yield dict(scope='user_version', username=username, version=version, **asdict(stats))
+            yield dict(scope='user', username=username, version=None, **asdict(self.users[username]))
+        for version, stats in self.versions.items():
+            yield dict(scope='version', username=None, version=version, **asdict(stats))
+        if self.overall:
+            yield dict(scope='overall', username=None, version=None, **asdict(self.overall))
+
+    def to_json(self):
+        return json.dumps(list(self.rows()), indent=2)
+
+    def to_csv(self):
+        out = io.StringIO()
+        writer = csv.DictWriter(out, fieldnames=['scope', 'username', 'version'] + list(Stats.__dataclass_fields__))
+        writer.writeheader()
+        writer.writerows(self.rows())
+        return out.getvalue()
+
+
+def load_classifications():
+    """Fetch every classification with its user and fake patch version in one query.
+
+    Returns the usernames and a dict of columns: ``user`` (index into the
+    usernames), ``version``, ``correct`` and ``time`` (seconds since the
+    epoch), in classification id order.
+    """
+    rows = (
+        db.session.query(
+            Classification.user_id,
+            Classification.timestamp,
+            Classification.classification,
+            Patch.version,
+        )
+        .join(Patch, Patch.id == Classification.fake_patch_id)
+        .order_by(Classification.id)
+        .all()
+    )
+    members = db.session.query(Member.id, Member.username).order_by(Member.id).all()
+    usernames = [username for (_, username) in members]
+    user_index = {user_id: i for i, (user_id, _) in enumerate(members)}
+
+    if rows:
+        user_ids, timestamps, correct, versions = zip(*rows)
+    else:
+        user_ids, timestamps, correct, versions = (), (), (), ()
+
+    columns = dict(
+        user=np.array([user_index.get(user_id, -1) for user_id in user_ids], dtype=np.int64),
+        version=np.array([0 if version is None else version for version in versions], dtype=np.int64),
+        correct=np.array(correct, dtype=bool),
+        time=np.array(timestamps, dtype='datetime64[us]').astype(np.int64) / 1e6,
+    )
+    return usernames, columns
+
+
+def _grouped_median(groups, values, n_groups):
+    """Median of ``values`` for each group in ``range(n_groups)``, or -1 if it's empty."""
+    medians = np.full(n_groups, -1.0)
+    if len(values) == 0:
+        return medians
+
+    order = np.lexsort((values, groups))
+    groups = groups[order]
+    values = values[order]
+    counts = np.bincount(groups, minlength=n_groups)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+    has = counts > 0
+    lo = starts[has] + (counts[has] - 1) // 2
+    hi = starts[has] + counts[has] // 2
+    medians[has] = (values[lo] + values[hi]) / 2
+    return medians
+
+
+def group_stats(groups, n_groups, correct, time):
+    """Compute ``Stats`` for each group in ``range(n_groups)`` in a few passes.
+
+    Time taken is the gap between consecutive classifications within a
+    group, in timestamp order, labelled with the earlier classification of
+    the two and ignoring gaps over ``MAX_TIME``. Groups with no
+    classifications get None.
+    """
+    total = np.bincount(groups, minlength=n_groups)
+    num_correct = np.bincount(groups, weights=correct, minlength=n_groups).astype(np.int64)
+    num_incorrect = total - num_correct
+    with np.errstate(invalid='ignore', divide='ignore'):
+        score = num_incorrect / total
+    error = np.abs(score - 0.5)
+
+    # stable sort so classifications with the same timestamp keep their order
+    order = np.lexsort((time, groups))
+    groups = groups[order]
+    correct = correct[order]
+    time = time[order]
+
+    same_group = groups[1:] == groups[:-1]
+    diffs = time[1:] - time[:-1]
+    keep = same_group & (diffs < MAX_TIME)
+    diff_groups = groups[:-1][keep]
+    diff_correct = correct[:-1][keep]
+    diffs = diffs[keep]
+
+    time_med = _grouped_median(diff_groups, diffs, n_groups)
+    correct_time_med = _grouped_median(diff_groups[diff_correct], diffs[diff_correct], n_groups)
+    incorrect_time_med = _grouped_median(diff_groups[~diff_correct], diffs[~diff_correct], n_groups)
+
+    return [
+        Stats(
+            total=int(total[i]),
+            num_correct=int(num_correct[i]),
+            num_incorrect=int(num_incorrect[i]),
+            score=float(score[i]),
+            error=float(error[i]),
+            time_med=float(time_med[i]),
+            correct_time_med=float(correct_time_med[i]),
+            incorrect_time_med=float(incorrect_time_med[i]),
+        ) if total[i] else None
+        for i in range(n_groups)
+    ]
+
+
+def classification_stats(exclude_users=()):
+    """Build a ``Report`` of accuracy and timing for every user and version.
+
+    Users in ``exclude_users`` still get their own stats but are left out of
+    the per-version and overall production figures.
+    """
+    usernames, columns = load_classifications()
+    user = columns['user']
+    correct = columns['correct']
+    time = columns['time']
+
+    versions, version = np.unique(columns['version'], return_inverse=True)
+    n_users = len(usernames)
+    n_versions = len(versions)
+
+    user_version = group_stats(user * n_versions + version, n_users * n_versions, correct, time)
+    user_overall = group_stats(user, n_users, correct, time)
+
+    user_versions = {}
+    users = {}
+    for u, username in enumerate(usernames):
+        if not user_overall[u]:
+            continue
+        user_versions[username] = {
+            int(versions[v]): user_version[u * n_versions + v]
+            for v in range(n_versions)
+            if user_version[u * n_versions + v]
+        }
+        users[username] = user_overall[u]
+
+    excluded = np.array([username in exclude_users for username in usernames], dtype=bool)
+    production = ~excluded[user] if n_users else np.zeros(0, dtype=bool)
+    p_version = version[production]
+    p_correct = correct[production]
+    p_time = time[production]
+
+    version_stats = group_stats(p_version, n_versions, p_correct, p_time)
+    overall = group_stats(np.zeros(len(p_version), dtype=np.int64), 1, p_correct, p_time)[0]
+
+    # weight each production user's error for a version by how many of that
+    # version they classified
+    for v in range(n_versions):
+        if not version_stats[v]:
+            continue
+        weighted = 0.0
+        for u in range(n_users):
+            stats = user_version[u * n_versions + v]
+            if stats and not excluded[u]:
+                weighted += stats.total * stats.error
+        version_stats[v].mean_weighted_error = weighted / version_stats[v].total
+
+    return Report(
+        user_versions=user_versions,
+        users=users,
+        versions={int(versions[v]): version_stats[v] for v in range(n_versions) if version_stats[v]},
+        overall=overall,
+    )
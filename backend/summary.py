@@ -0,0 +1,127 @@
+from collections import defaultdict
+from datetime import timezone
+
+from backend.model import db, ClassificationSummary, Member
+from backend.stats import MAX_TIME
+
+
+def _utc(timestamp):
+    # sqlite hands back naive datetimes, which are always in UTC
+    if timestamp.tzinfo is None:
+        return timestamp
+    return timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def record(user_id, classifications):
+    """Add a user's new classifications to their running totals.
+
+    ``classifications`` are (version, correct, timestamp) tuples. Times are
+    measured the same way as ``backend.stats``: the gap to the previous
+    classification of the same version, labelled by whether that previous
+    one was correct. The caller commits, so the totals land in the same
+    transaction as the classifications.
+    """
+    by_version = defaultdict(list)
+    for version, correct, timestamp in classifications:
+        by_version[0 if version is None else version].append((_utc(timestamp), correct))
+
+    summaries = {
+        summary.version: summary
+        for summary in ClassificationSummary.query
+        .filter_by(user_id=user_id)
+        .filter(ClassificationSummary.version.in_(list(by_version)))
+    }
+
+    for version, rows in by_version.items():
+        summary = summaries.get(version)
+        if not summary:
+            summary = ClassificationSummary(
+                user_id=user_id,
+                version=version,
+                num_correct=0,
+                num_incorrect=0,
+                time_count=0,
+                time_total=0,
+                correct_time_count=0,
+                correct_time_total=0,
+                incorrect_time_count=0,
+                incorrect_time_total=0,
+            )
+            db.session.add(summary)
+
+        for timestamp, correct in sorted(rows, key=lambda row: row[0]):
+            if correct:
+                summary.num_correct += 1
+            else:
+                summary.num_incorrect += 1
+
+            # answers that arrive out of order only count towards the totals
+            if summary.last_timestamp is not None:
+                if timestamp < summary.last_timestamp:
+                    continue
+                diff = (timestamp - summary.last_timestamp).total_seconds()
+                if diff < MAX_TIME:
+                    summary.time_count += 1
+                    summary.time_total += diff
+                    if summary.last_correct:
+                        summary.correct_time_count += 1
+                        summary.correct_time_total += diff
+                    else:
+                        summary.incorrect_time_count += 1
+                        summary.incorrect_time_total += diff
+
+            summary.last_timestamp = timestamp
+            summary.last_correct = correct
+
+
+def _mean(total, count):
+    return total / count if count else -1
+
+
+def version_summary(exclude_users=()):
+    """Score, error and mean times for each version across production users.
+
+    Reads one row per user and version, so the cost doesn't grow with the
+    number of classifications.
+    """
+    rows = (
+        db.session.query(ClassificationSummary)
+        .join(Member, Member.id == ClassificationSummary.user_id)
+        .filter(~Member.username.in_(list(exclude_users)))
+        .all()
+    )
+
+    versions = defaultdict(list)
+    for row in rows:
+        versions[row.version].append(row)
+
+    summary = {}
+    for version, rows in sorted(versions.items()):
+        num_correct = sum(row.num_correct for row in rows)
+        num_incorrect = sum(row.num_incorrect for row in rows)
+        total = num_correct + num_incorrect
+        if not total:
+            continue
+        score = num_incorrect / total
+
+        # each user's error, weighted by how many of this version they did
+        weighted_error = 0
+        for row in rows:
+            user_total = row.num_correct + row.num_incorrect
+            if user_total:
+                weighted_error += user_total * abs(row.num_incorrect / user_total - 0.5)
+
+        summary[version] = dict(
+            total=total,
+            num_correct=num_correct,
+            num_incorrect=num_incorrect,
+            score=score,
+            error=abs(score - 0.5),
+            mean_weighted_error=weighted_error / total,
+            users=len(rows),
+            time_mean=_mean(sum(row.time_total for row in rows), sum(row.time_count for row in rows)),
+            correct_time_mean=_mean(sum(row.correct_time_total for row in rows), sum(row.correct_time_count for row in rows)),
+            incorrect_time_mean=_mean(sum(row.incorrect_time_total for row in rows), sum(row.incorrect_time_count for row in rows)),
+        )
+
+    return summary
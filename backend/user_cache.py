@@ -0,0 +1,67 @@
+from collections import OrderedDict
+import threading
+import time
+
+from flask_login import UserMixin
+
+from backend.model import db, Member
+
+
+class CachedMember(UserMixin):
+    """The parts of a ``Member`` needed to authenticate a request.
+
+    It isn't attached to a session, so anything that changes (like the
+    classification count) has to be read from the database when needed.
+    """
+
+    def __init__(self, id, username):
+        self.id = id
+        self.username = username
+
+
+class UserCache:
+    """An LRU of logged in users, so requests don't need a query to authenticate.
+
+    Entries expire after ``ttl`` seconds, which is as long as a user changed
+    or deleted by another process (like ``manage_database``) can still be
+    used here. A deleted user stays logged in until then, but saving
+    answers checks the member still exists, so they can't record anything.
+    """
+
+    def __init__(self, max_size=1024, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._users = OrderedDict()
+
+    def get(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            cached = self._users.get(user_id)
+            if cached and cached[1] > now:
+                self._users.move_to_end(user_id)
+                return cached[0]
+
+        row = db.session.query(Member.id, Member.username).filter_by(id=user_id).first()
+        if not row:
+            self.invalidate(user_id)
+            return None
+
+        user = CachedMember(row.id, row.username)
+        with self._lock:
+            self._users[user_id] = (user, now + self.ttl)
+            self._users.move_to_end(user_id)
+            while len(self._users) > self.max_size:
+                self._users.popitem(last=False)
+        return user
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._users.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._users.clear()
+
+
+user_cache = UserCache()
@@ -0,0 +1,158 @@
+"""Synthetic patches and raters for benchmarking.
+
+``PATCH_DIR`` and ``DATABASE_URL`` must point at scratch locations before
+anything from ``backend`` is imported, since both are read at import time.
+"""
+from datetime import datetime, timedelta
+import os
+import random
+import struct
+import zlib
+
+from werkzeug.security import generate_password_hash
+
+PASSWORD = 'benchmark'
+
+
+def png(width, height, seed=0):
+    """A valid RGB PNG of noise, so it compresses about as badly as a real patch."""
+    rng = random.Random(seed)
+    rows = b''.join(b'\x00' + rng.randbytes(width * 3) for _ in range(height))
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    return (
+        b'\x89PNG\r\n\x1a\n'
+        + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+        + chunk(b'IDAT', zlib.compress(rows, 1))
+        + chunk(b'IEND', b'')
+    )
+
+
+def write_patches(patch_dir, num_patches, versions=(1,), size=256):
+    """Write ``num_patches`` real and fake placeholder patches, cycling through ``versions``."""
+    for directory in ('real', 'fake'):
+        os.makedirs(os.path.join(patch_dir, directory), exist_ok=True)
+
+    # every patch is the same size, so encode one image per directory and
+    # reuse it rather than paying for zlib on every file
+    images = {directory: png(size, size, seed) for seed, directory in enumerate(('real', 'fake'))}
+    for i in range(num_patches):
+        version = versions[i % len(versions)]
+        filename = f'{i}.png' if version == 0 else f'{i}_{version}.png'
+        for directory, image in images.items():
+            with open(os.path.join(patch_dir, directory, filename), 'wb') as f:
+                f.write(image)
+
+
+def seed_database(num_users):
+    """Create the schema, one member per simulated rater and the patch rows.
+
+    Returns the usernames, which all have ``PASSWORD``.
+    """
+    from backend import manage_database
+    from backend.index import app
+    from backend.model import db, Member
+
+    manage_database.create_db()
+    password = generate_password_hash(PASSWORD)
+    usernames = [f'rater{i}' for i in range(num_users)]
+    with app.app_context():
+        db.session.bulk_insert_mappings(Member, [
+            dict(username=username, password=password, num_classifications=0)
+            for username in usernames
+        ])
+        db.session.commit()
+    manage_database.initialise_patches()
+
+    return usernames
+
+
+def seed_history(num_classifications, skew=1.0, seed=0, chunk_size=10000):
+    """Give the seeded members a skewed history of about ``num_classifications`` answers.
+
+    How much each member has done and how often each patch has been rated
+    both fall off like a Zipf distribution with exponent ``skew``, so a few
+    raters and the lowest-id patches have most of the ratings, as they would
+    after serving patches in id order. Member and patch counters and the
+    summary table are filled in to match.
+    """
+    from backend import scheduler, summary
+    from backend.index import app
+    from backend.model import db, Classification, Member, Patch
+
+    rng = random.Random(seed)
+    with app.app_context():
+        user_ids = [user_id for (user_id,) in db.session.query(Member.id).order_by(Member.id)]
+        patches = {True: [], False: []}
+        versions = {}
+        for patch_id, real, version in db.session.query(Patch.id, Patch.real, Patch.version).order_by(Patch.id):
+            patches[bool(real)].append(patch_id)
+            versions[patch_id] = version
+        if not user_ids or not patches[True] or not patches[False]:
+            return 0
+
+        def zipf_weights(n):
+            weights, total = [], 0.0
+            for rank in range(1, n + 1):
+                total += rank ** -skew
+                weights.append(total)
+            return weights
+
+        user_weights = zipf_weights(len(user_ids))
+        shares = [0] * len(user_ids)
+        for i in rng.choices(range(len(user_ids)), cum_weights=user_weights, k=num_classifications):
+            shares[i] += 1
+
+        real_weights = zipf_weights(len(patches[True]))
+        fake_weights = zipf_weights(len(patches[False]))
+        max_pairs = len(patches[True]) * len(patches[False])
+        start = datetime(2023, 6, 1)
+
+        total = 0
+        for user_id, share in zip(user_ids, shares):
+            pairs = set()
+            share = min(share, max_pairs)
+            while len(pairs) < share:
+                real_ids = rng.choices(patches[True], cum_weights=real_weights, k=share - len(pairs))
+                fake_ids = rng.choices(patches[False], cum_weights=fake_weights, k=share - len(pairs))
+                pairs.update(zip(real_ids, fake_ids))
+
+            timestamp = start + timedelta(seconds=rng.randrange(30 * 24 * 60 * 60))
+            rows = []
+            for real_patch_id, fake_patch_id in pairs:
+                timestamp += timedelta(seconds=rng.uniform(2, 30))
+                rows.append(dict(
+                    real_patch_id=real_patch_id,
+                    fake_patch_id=fake_patch_id,
+                    user_id=user_id,
+                    classification=rng.random() < 0.6,
+                    timestamp=timestamp,
+                ))
+
+            for i in range(0, len(rows), chunk_size):
+                db.session.bulk_insert_mappings(Classification, rows[i:i + chunk_size])
+            summary.record(user_id, [
+                (versions[row['fake_patch_id']], row['classification'], row['timestamp'])
+                for row in rows
+            ])
+            db.session.query(Member).filter_by(id=user_id).update({Member.num_classifications: len(rows)})
+            db.session.commit()
+            total += len(rows)
+
+        scheduler.recount_ratings()
+        db.session.commit()
+
+    return total
+
+
+def generate(patch_dir, num_members, num_patches, num_classifications, versions=(1,), skew=1.0, size=64, seed=0):
+    """Fill the scratch database and patch directory with a synthetic study.
+
+    Returns the usernames, which all have ``PASSWORD``, heaviest raters first.
+    """
+    write_patches(patch_dir, num_patches, versions, size)
+    usernames = seed_database(num_members)
+    seed_history(num_classifications, skew, seed)
+    return usernames
@@ -0,0 +1,237 @@
+"""Drive the app with concurrent simulated raters and report latency per endpoint.
+
+Each rater logs in, then repeatedly loads the classification page, asks for
+its next pair, fetches both images and submits an answer. By default the
+app runs in-process against a scratch database and patch directory seeded
+with synthetic data; with --url it drives a running server instead, which
+must already have the rater accounts (see benchmarks/fixtures.py).
+
+    python -m benchmarks.load_test --raters 20 --pairs 50
+    python -m benchmarks.load_test --save-baseline
+    python -m benchmarks.load_test --compare
+
+Latencies depend on the machine, so there's no baseline in the repo. Save
+one with --save-baseline on the machine the comparison will run on, from
+the commit to compare against, then run --compare with the same options
+after the change. --compare exits with status 1 if any endpoint's p95
+latency regressed past the tolerance relative to the saved baseline.
+
+Requests count as errors if they fail, or if they answer with JSON saying
+``success: false``, such as a rejected classification.
+"""
+import argparse
+from collections import defaultdict
+import http.cookiejar
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+
+class TestClient:
+    """Sends requests to the app in-process."""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def get(self, path):
+        response = self.client.get(path)
+        return response.status_code, response.data
+
+    def post(self, path, data):
+        response = self.client.post(path, data=data)
+        return response.status_code, response.data
+
+
+class HttpClient:
+    """Sends requests to a running server, keeping its own cookies."""
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar())
+        )
+
+    def _open(self, request):
+        try:
+            with self.opener.open(request) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+    def get(self, path):
+        return self._open(urllib.request.Request(self.url + path))
+
+    def post(self, path, data):
+        return self._open(urllib.request.Request(self.url + path, data=urllib.parse.urlencode(data).encode()))
+
+
+def failed(status, body):
+    """Whether a response is an error, including JSON ones that report ``success: false``."""
+    if status >= 400:
+        return True
+    if not body.startswith(b'{'):
+        return False
+    try:
+        return json.loads(body).get('success') is False
+    except ValueError:
+        return False
+
+
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def timed(self, endpoint, request, *args):
+        start = time.perf_counter()
+        status, body = request(*args)
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.latencies[endpoint].append(elapsed)
+            if failed(status, body):
+                self.errors[endpoint] += 1
+        return status, body
+
+
+def rater(client, recorder, username, password, pairs):
+    recorder.timed('/login', client.post, '/login', dict(username=username, password=password))
+
+    for _ in range(pairs):
+        recorder.timed('/', client.get, '/')
+
+        status, body = recorder.timed('/classification/next', client.get, '/classification/next')
+        if status != 200:
+            continue
+        next_pairs = json.loads(body).get('pairs')
+        if not next_pairs:
+            # this rater has classified everything
+            return
+        pair = next_pairs[0]
+
+        for image in (pair['patch1'], pair['patch2']):
+            recorder.timed('/patch', client.get, image['src'])
+
+        recorder.timed('/classification', client.post, '/classification', dict(
+            real_patch_id=pair['real_patch_id'],
+            fake_patch_id=pair['fake_patch_id'],
+            classification=random.choice(['real', 'fake']),
+            token=pair['token'],
+        ))
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def summarise(recorder, elapsed):
+    results = {}
+    for endpoint, latencies in sorted(recorder.latencies.items()):
+        results[endpoint] = dict(
+            requests=len(latencies),
+            errors=recorder.errors[endpoint],
+            throughput=len(latencies) / elapsed,
+            p50=percentile(latencies, 50) * 1000,
+            p95=percentile(latencies, 95) * 1000,
+            p99=percentile(latencies, 99) * 1000,
+        )
+    return results
+
+
+def print_results(results, elapsed):
+    total = sum(r['requests'] for r in results.values())
+    print(f'{total} requests in {elapsed:.1f}s ({total / elapsed:.1f} req/s)')
+    print(f"{'endpoint':<24}{'requests':>10}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for endpoint, r in results.items():
+        print(f"{endpoint:<24}{r['requests']:>10}{r['errors']:>8}{r['throughput']:>10.1f}{r['p50']:>10.2f}{r['p95']:>10.2f}{r['p99']:>10.2f}")
+
+
+def compare(results, baseline, tolerance):
+    """Print how each endpoint's p95 moved from the baseline, returning True if any regressed."""
+    regressed = False
+    for endpoint, r in results.items():
+        if endpoint not in baseline:
+            continue
+        before = baseline[endpoint]['p95']
+        change = (r['p95'] - before) / before if before else 0
+        status = 'ok'
+        if change > tolerance:
+            status = 'REGRESSED'
+            regressed = True
+        print(f"{endpoint:<24} p95 {before:.2f}ms -> {r['p95']:.2f}ms ({change:+.0%}) {status}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--raters', type=int, default=10, help='number of concurrent raters')
+    parser.add_argument('--pairs', type=int, default=20, help='pairs each rater classifies')
+    parser.add_argument('--patches', type=int, default=1000, help='real and fake patches to seed')
+    parser.add_argument('--image-size', type=int, default=256, help='width and height of seeded patches')
+    parser.add_argument('--url', help='drive a running server instead of the app in-process')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--compare', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed p95 slowdown when comparing')
+    args = parser.parse_args()
+
+    from benchmarks import fixtures
+
+    if args.url:
+        usernames = [f'rater{i}' for i in range(args.raters)]
+        clients = [HttpClient(args.url) for _ in usernames]
+    else:
+        # both are read when backend is imported, so set them up first
+        scratch = tempfile.mkdtemp(prefix='kidney-bench-')
+        os.environ['PATCH_DIR'] = os.path.join(scratch, 'patches')
+        os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(scratch, 'db.sqlite')
+        fixtures.write_patches(os.environ['PATCH_DIR'], args.patches, size=args.image_size)
+        usernames = fixtures.seed_database(args.raters)
+
+        from backend.index import app
+        clients = [TestClient(app) for _ in usernames]
+
+    recorder = Recorder()
+    threads = [
+        threading.Thread(target=rater, args=(client, recorder, username, fixtures.PASSWORD, args.pairs))
+        for client, username in zip(clients, usernames)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    results = summarise(recorder, elapsed)
+    print_results(results, elapsed)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print('saved baseline to', args.baseline)
+
+    if args.compare:
+        try:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        except FileNotFoundError:
+            print('no baseline at', args.baseline + ', save one first with --save-baseline')
+            return 1
+        if compare(results, baseline, args.tolerance):
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
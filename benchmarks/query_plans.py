@@ -0,0 +1,224 @@
+"""Check the hot queries still use indexes, and stay within budget, on a large synthetic study.
+
+Fills a scratch database and patch directory with synthetic members, patches
+and a skewed classification history (see benchmarks/fixtures.py), then
+drives the rater endpoints in-process and captures every statement they
+run. It checks that:
+
+- no statement's EXPLAIN QUERY PLAN scans the classification or patch
+  tables. While a worker first loads its pools, scans of a covering index
+  are allowed, since those loads read every patch or rating on purpose.
+- each endpoint runs no more than its budgeted number of statements per
+  request.
+- each endpoint's median time, and the time to build the stats reports,
+  is within budget.
+
+    python -m benchmarks.query_plans
+    python -m benchmarks.query_plans --members 500 --patches 50000 --classifications 2000000
+
+Exits with status 1 if any check fails.
+"""
+import argparse
+from contextlib import contextmanager
+import os
+import re
+import statistics
+import sys
+import tempfile
+import time
+
+# most statements each endpoint may run per request, once the worker is warm,
+# including the occasional sweep of expired pair leases
+STATEMENT_BUDGETS = {
+    '/': 7,
+    '/classification/next': 7,
+    '/classification/batch': 15,
+    '/patch': 0,
+}
+
+# median milliseconds per request, once the worker is warm
+TIME_BUDGETS = {
+    '/': 50,
+    '/classification/next': 50,
+    '/classification/batch': 100,
+    '/patch': 10,
+}
+
+# seconds to build each stats report
+STATS_BUDGETS = {
+    'classification_stats': 30,
+    'version_summary': 1,
+}
+
+TABLES = ('classification', 'patch', 'pair_lease')
+SCAN = re.compile(r'^SCAN (\w+)')
+
+
+class Capture:
+    """Records the statements run against the engine while active."""
+
+    def __init__(self):
+        self.statements = []
+        self.active = False
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if self.active and not executemany:
+            self.statements.append((statement, parameters))
+
+    @contextmanager
+    def __call__(self):
+        self.statements = []
+        self.active = True
+        try:
+            yield self
+        finally:
+            self.active = False
+
+
+def plan_problems(engine, statements, allow_covering):
+    """Return a description of each statement whose plan scans a checked table."""
+    problems = []
+    with engine.connect() as conn:
+        for statement, parameters in statements:
+            if not statement.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE', 'INSERT', 'WITH')):
+                continue
+            plan = conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+            for row in plan:
+                detail = row[-1]
+                match = SCAN.match(detail)
+                if not match or match.group(1) not in TABLES:
+                    continue
+                if allow_covering and 'COVERING INDEX' in detail:
+                    continue
+                problems.append(f'{detail}: {" ".join(statement.split())}')
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--members', type=int, default=200)
+    parser.add_argument('--patches', type=int, default=20000, help='real and fake patches to seed')
+    parser.add_argument('--versions', type=int, default=3, help='patch versions to spread the patches across')
+    parser.add_argument('--classifications', type=int, default=200000)
+    parser.add_argument('--skew', type=float, default=1.0, help='zipf exponent of the classification history')
+    parser.add_argument('--requests', type=int, default=20, help='requests to time per endpoint')
+    args = parser.parse_args()
+
+    # both are read when backend is imported, so set them up first
+    scratch = tempfile.mkdtemp(prefix='kidney-plans-')
+    os.environ['PATCH_DIR'] = os.path.join(scratch, 'patches')
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(scratch, 'db.sqlite')
+    versions = tuple(range(1, args.versions + 1))
+    os.environ['EXPERIMENT_VERSIONS'] = ','.join(map(str, versions))
+
+    from benchmarks import fixtures
+
+    start = time.perf_counter()
+    usernames = fixtures.generate(
+        os.environ['PATCH_DIR'], args.members, args.patches, args.classifications,
+        versions=versions, skew=args.skew,
+    )
+    print(f'generated {args.members} members, {args.patches} patches per class and '
+          f'{args.classifications} classifications in {time.perf_counter() - start:.1f}s')
+
+    from sqlalchemy import event
+
+    from backend import stats, summary
+    from backend.index import app
+    from backend.model import db
+
+    capture = Capture()
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', capture.before_cursor_execute)
+
+    failures = []
+
+    # the heaviest rater, whose history is the most expensive to look through
+    client = app.test_client()
+    client.post('/login', data=dict(username=usernames[0], password=fixtures.PASSWORD))
+
+    # the user's first answer also creates their pair cursor, a one-off
+    # that walks their history
+    with capture():
+        client.get('/')
+        pair = client.get('/classification/next?count=5').get_json()['pairs'][0]
+        client.post('/classification/batch', json=dict(classifications=[dict(
+            real_patch_id=pair['real_patch_id'],
+            fake_patch_id=pair['fake_patch_id'],
+            classification='real',
+            token=pair['token'],
+        )]))
+    warm_up = capture.statements
+    failures += plan_problems(engine, warm_up, allow_covering=True)
+
+    timings = {endpoint: [] for endpoint in STATEMENT_BUDGETS}
+    statement_counts = {endpoint: [] for endpoint in STATEMENT_BUDGETS}
+    steady = []
+
+    def timed(endpoint, request, *args, **kwargs):
+        with capture():
+            start = time.perf_counter()
+            response = request(*args, **kwargs)
+            timings[endpoint].append((time.perf_counter() - start) * 1000)
+        statement_counts[endpoint].append(len(capture.statements))
+        steady.extend(capture.statements)
+        if response.status_code >= 400:
+            failures.append(f'{endpoint} returned {response.status_code}')
+        return response
+
+    for _ in range(args.requests):
+        timed('/', client.get, '/')
+        pairs = timed('/classification/next', client.get, '/classification/next?count=10').get_json()['pairs']
+        if not pairs:
+            break
+        for pair in pairs[:1]:
+            for image in (pair['patch1'], pair['patch2']):
+                timed('/patch', client.get, image['src'])
+        timed('/classification/batch', client.post, '/classification/batch', json=dict(
+            classifications=[
+                dict(
+                    real_patch_id=pair['real_patch_id'],
+                    fake_patch_id=pair['fake_patch_id'],
+                    classification='real',
+                    token=pair['token'],
+                )
+                for pair in pairs
+            ],
+            count=5,
+        ))
+
+    failures += plan_problems(engine, steady, allow_covering=False)
+
+    print(f"{'endpoint':<24}{'statements':>12}{'budget':>8}{'median ms':>12}{'budget':>8}")
+    for endpoint, budget in STATEMENT_BUDGETS.items():
+        if not timings[endpoint]:
+            continue
+        most = max(statement_counts[endpoint])
+        median = statistics.median(timings[endpoint])
+        print(f'{endpoint:<24}{most:>12}{budget:>8}{median:>12.2f}{TIME_BUDGETS[endpoint]:>8}')
+        if most > budget:
+            failures.append(f'{endpoint} ran {most} statements, over its budget of {budget}')
+        if median > TIME_BUDGETS[endpoint]:
+            failures.append(f'{endpoint} took {median:.1f}ms, over its budget of {TIME_BUDGETS[endpoint]}ms')
+
+    with app.app_context():
+        for name, report in (
+            ('classification_stats', lambda: stats.classification_stats(app.config['TEST_USERS'])),
+            ('version_summary', lambda: summary.version_summary(app.config['TEST_USERS'])),
+        ):
+            start = time.perf_counter()
+            report()
+            elapsed = time.perf_counter() - start
+            print(f'{name:<24}{elapsed:>12.2f}s, budget {STATS_BUDGETS[name]}s')
+            if elapsed > STATS_BUDGETS[name]:
+                failures.append(f'{name} took {elapsed:.1f}s, over its budget of {STATS_BUDGETS[name]}s')
+
+    for failure in failures:
+        print('FAIL', failure)
+    print('ok' if not failures else f'{len(failures)} checks failed')
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
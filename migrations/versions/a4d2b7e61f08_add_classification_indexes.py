@@ -0,0 +1,43 @@
+"""Add classification indexes and member classification count
+
+Revision ID: a4d2b7e61f08
+Revises: 5c1e8a3f9d27
+Create Date: 2023-06-15 16:02:11.904387
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4d2b7e61f08'
+down_revision = '5c1e8a3f9d27'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_classification_user_pair', 'classification', ['user_id', 'real_patch_id', 'fake_patch_id'], unique=False)
+    op.create_index('ix_classification_real_patch_id', 'classification', ['real_patch_id'], unique=False)
+    op.create_index('ix_classification_fake_patch_id', 'classification', ['fake_patch_id'], unique=False)
+    op.add_column('member', sa.Column('num_classifications', sa.Integer(), server_default='0', nullable=False))
+
+    # backfill the count of unique pairs each user has already classified
+    conn = op.get_bind()
+    counts = conn.execute(sa.text(
+        'SELECT user_id, COUNT(*) FROM '
+        '(SELECT DISTINCT user_id, real_patch_id, fake_patch_id FROM classification) AS pairs '
+        'GROUP BY user_id'
+    )).fetchall()
+    for user_id, count in counts:
+        conn.execute(
+            sa.text('UPDATE member SET num_classifications = :count WHERE id = :user_id'),
+            {'count': count, 'user_id': user_id},
+        )
+
+
+def downgrade():
+    op.drop_column('member', 'num_classifications')
+    op.drop_index('ix_classification_fake_patch_id', table_name='classification')
+    op.drop_index('ix_classification_real_patch_id', table_name='classification')
+    op.drop_index('ix_classification_user_pair', table_name='classification')
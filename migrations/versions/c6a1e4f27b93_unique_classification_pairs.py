@@ -0,0 +1,44 @@
+"""Make classifications unique per user and pair
+
+Revision ID: c6a1e4f27b93
+Revises: 3b9f6d2c8a51
+Create Date: 2023-06-26 14:38:05.117642
+
+"""
+from alembic import context, op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c6a1e4f27b93'
+down_revision = '3b9f6d2c8a51'
+branch_labels = None
+depends_on = None
+
+
+def _rebuild_summary(conn):
+    # the running totals counted the duplicates too, so recompute them the
+    # same way e97f3c05b4d1 first filled them in
+    conn.execute(sa.text('DELETE FROM classification_summary'))
+    context.script.get_revision('e97f3c05b4d1').module.fill_summary(conn)
+
+
+def upgrade():
+    op.drop_index('ix_classification_user_pair', table_name='classification')
+
+    # keep each user's first answer for a pair and drop the repeats
+    conn = op.get_bind()
+    deleted = conn.execute(sa.text(
+        'DELETE FROM classification WHERE id NOT IN '
+        '(SELECT MIN(id) FROM classification GROUP BY user_id, real_patch_id, fake_patch_id)'
+    )).rowcount
+    if deleted:
+        _rebuild_summary(conn)
+
+    op.create_index('ix_classification_user_pair', 'classification', ['user_id', 'real_patch_id', 'fake_patch_id'], unique=True)
+
+
+def downgrade():
+    # the duplicates are gone for good, only the constraint comes off
+    op.drop_index('ix_classification_user_pair', table_name='classification')
+    op.create_index('ix_classification_user_pair', 'classification', ['user_id', 'real_patch_id', 'fake_patch_id'], unique=False)
@@ -0,0 +1,110 @@
+"""Add classification summary
+
+Revision ID: e97f3c05b4d1
+Revises: a4d2b7e61f08
+Create Date: 2023-06-19 11:47:30.226145
+
+"""
+from collections import defaultdict
+from datetime import datetime, timezone
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e97f3c05b4d1'
+down_revision = 'a4d2b7e61f08'
+branch_labels = None
+depends_on = None
+
+# assume nobody will take longer than 5 mins per image
+MAX_TIME = 5 * 60
+
+
+def _timestamp(value):
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def fill_summary(conn):
+    """Fill in the running totals from the existing classifications.
+
+    Also used by c6a1e4f27b93, to recompute them once duplicates are gone.
+    """
+    rows = conn.execute(sa.text(
+        'SELECT c.user_id, p.version, c.classification, c.timestamp '
+        'FROM classification c JOIN patch p ON p.id = c.fake_patch_id '
+        'WHERE c.user_id IS NOT NULL AND c.timestamp IS NOT NULL '
+        'ORDER BY c.user_id, c.timestamp, c.id'
+    ))
+
+    summaries = defaultdict(lambda: dict(
+        num_correct=0,
+        num_incorrect=0,
+        last_timestamp=None,
+        last_correct=None,
+        time_count=0,
+        time_total=0.0,
+        correct_time_count=0,
+        correct_time_total=0.0,
+        incorrect_time_count=0,
+        incorrect_time_total=0.0,
+    ))
+    for user_id, version, correct, timestamp in rows:
+        s = summaries[(user_id, version or 0)]
+        timestamp = _timestamp(timestamp)
+        s['num_correct' if correct else 'num_incorrect'] += 1
+        if s['last_timestamp'] is not None:
+            diff = (timestamp - s['last_timestamp']).total_seconds()
+            if diff < MAX_TIME:
+                label = 'correct' if s['last_correct'] else 'incorrect'
+                s['time_count'] += 1
+                s['time_total'] += diff
+                s[f'{label}_time_count'] += 1
+                s[f'{label}_time_total'] += diff
+        s['last_timestamp'] = timestamp
+        s['last_correct'] = bool(correct)
+
+    if summaries:
+        summary = sa.table(
+            'classification_summary',
+            *(sa.column(name) for name in ('user_id', 'version') + tuple(next(iter(summaries.values()))))
+        )
+        op.bulk_insert(summary, [
+            dict(user_id=user_id, version=version, **s)
+            for (user_id, version), s in summaries.items()
+        ])
+
+
+def upgrade():
+    # ### commands auto generated by Alembic - please adjust! ###
+    op.create_table('classification_summary',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.Column('num_correct', sa.Integer(), nullable=False),
+    sa.Column('num_incorrect', sa.Integer(), nullable=False),
+    sa.Column('last_timestamp', sa.DateTime(), nullable=True),
+    sa.Column('last_correct', sa.Boolean(), nullable=True),
+    sa.Column('time_count', sa.Integer(), nullable=False),
+    sa.Column('time_total', sa.Float(), nullable=False),
+    sa.Column('correct_time_count', sa.Integer(), nullable=False),
+    sa.Column('correct_time_total', sa.Float(), nullable=False),
+    sa.Column('incorrect_time_count', sa.Integer(), nullable=False),
+    sa.Column('incorrect_time_total', sa.Float(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['member.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'version')
+    )
+    # ### end Alembic commands ###
+
+    # backfill the running totals from the existing classifications
+    fill_summary(op.get_bind())
+
+
+def downgrade():
+    # ### commands auto generated by Alembic - please adjust! ###
+    op.drop_table('classification_summary')
+    # ### end Alembic commands ###
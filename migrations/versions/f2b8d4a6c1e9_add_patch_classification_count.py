@@ -0,0 +1,32 @@
+"""Add patch classification count
+
+Revision ID: f2b8d4a6c1e9
+Revises: 8e2d5b9c4f17
+Create Date: 2023-06-30 11:24:08.516392
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2b8d4a6c1e9'
+down_revision = '8e2d5b9c4f17'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('patch', sa.Column('num_classifications', sa.Integer(), server_default='0', nullable=False))
+
+    # backfill how many times each patch has already been classified, as
+    # either side of a pair
+    op.execute(
+        'UPDATE patch SET num_classifications = '
+        '(SELECT COUNT(*) FROM classification WHERE classification.real_patch_id = patch.id) + '
+        '(SELECT COUNT(*) FROM classification WHERE classification.fake_patch_id = patch.id)'
+    )
+
+
+def downgrade():
+    op.drop_column('patch', 'num_classifications')